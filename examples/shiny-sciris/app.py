@@ -37,8 +37,8 @@ def loaddata(verbose=True):
 app = sw.ScirisApp(__name__, name="PyShiny")
 df = loaddata()
 
-# Define the RPCs
-@app.register_RPC()
+# Define the RPCs -- both are pure functions of their arguments, so their results can be cached
+@app.register_RPC(cache=True)
 def getoptions(tojson=True):
     options = sc.odict([
         ('Advertising',    'advert'),
@@ -53,7 +53,7 @@ def getoptions(tojson=True):
         output = options
     return output
 
-@app.register_RPC()
+@app.register_RPC(cache=dict(ttl=3600, maxsize=100))
 def plotdata(trendselection=None, startdate='2000-01-01', enddate='2018-01-01', trendline=False):
     
     print(f'Plotting data for type={trendselection}, start={startdate}, end={enddate}')
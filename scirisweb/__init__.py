@@ -9,14 +9,20 @@ Version: 2020mar13
 '''
 
 # Import everything
-from .sw_version   import * # analysis:ignore
-from .sw_rpcs      import * # analysis:ignore
-from .sw_users     import * # analysis:ignore
-from .sw_tasks     import * # analysis:ignore
-from .sw_datastore import * # analysis:ignore
-from .sw_app       import * # analysis:ignore
-from .sw_config    import * # analysis:ignore
-from .sw_server    import * # analysis:ignore
+from .sw_version     import * # analysis:ignore
+from .sw_rpcs        import * # analysis:ignore
+from .sw_metrics     import * # analysis:ignore
+from .sw_tempspace   import * # analysis:ignore
+from .sw_users       import * # analysis:ignore
+from .sw_tasks       import * # analysis:ignore
+from .sw_datastore   import * # analysis:ignore
+from .sw_accounting  import * # analysis:ignore
+from .sw_sharding    import * # analysis:ignore
+from .sw_writebehind import * # analysis:ignore
+from .sw_backup      import * # analysis:ignore
+from .sw_app         import * # analysis:ignore
+from .sw_config      import * # analysis:ignore
+from .sw_server      import * # analysis:ignore
 
 # Print the license...or not
 # print(__license__)
\ No newline at end of file
@@ -0,0 +1,315 @@
+"""
+sw_accounting.py -- storage accounting for DataStores
+
+Keeps the number of keys and bytes stored for each objtype and owner, and the size,
+type, and owner of each key, so that `DataStore.usage()` is fast and quotas can be
+checked when saving. RedisDataStore keeps them in Redis hashes; SQLDataStore and
+FileDataStore keep them in SQL tables.
+"""
+
+import json
+import collections
+import sqlalchemy
+import sciris as sc
+from .sw_datastore import max_key_length, usage_key, keyinfo_key
+
+__all__ = ['RedisAccounting', 'SQLAccounting']
+
+
+class RedisAccounting(sc.prettyobj):
+    '''
+    Storage accounting for RedisDataStore, kept in two hashes: the counters, and the
+    size, type, and owner of each key. Each update is a single Lua script, so it is
+    atomic and takes O(1) time.
+    '''
+
+    script = """
+    local old = redis.call('HGET', KEYS[2], ARGV[1])
+    if old then
+        local info = cjson.decode(old)
+        local size = tonumber(info[3])
+        redis.call('HINCRBY', KEYS[1], 'objtype:keys:'  .. info[1], -1)
+        redis.call('HINCRBY', KEYS[1], 'objtype:bytes:' .. info[1], -size)
+        redis.call('HINCRBY', KEYS[1], 'owner:keys:'    .. info[2], -1)
+        redis.call('HINCRBY', KEYS[1], 'owner:bytes:'   .. info[2], -size)
+    end
+    if ARGV[4] == '' then
+        redis.call('HDEL', KEYS[2], ARGV[1])
+    else
+        local size = tonumber(ARGV[4])
+        redis.call('HSET', KEYS[2], ARGV[1], cjson.encode({ARGV[2], ARGV[3], ARGV[4]}))
+        redis.call('HINCRBY', KEYS[1], 'objtype:keys:'  .. ARGV[2], 1)
+        redis.call('HINCRBY', KEYS[1], 'objtype:bytes:' .. ARGV[2], size)
+        redis.call('HINCRBY', KEYS[1], 'owner:keys:'    .. ARGV[3], 1)
+        redis.call('HINCRBY', KEYS[1], 'owner:bytes:'   .. ARGV[3], size)
+    end
+    """
+
+    reservescript = """
+    local old = redis.call('HGET', KEYS[2], ARGV[1])
+    local info = old and cjson.decode(old)
+    local owner = ARGV[3]
+    if ARGV[4] == '0' then
+        owner = info and info[2] or ARGV[7]
+    end
+    local size = tonumber(ARGV[5])
+    local quota = cjson.decode(ARGV[6])
+    local limit = -1
+    if owner ~= '' then
+        limit = quota[owner] or quota['*'] or -1
+    end
+    local used = tonumber(redis.call('HGET', KEYS[1], 'owner:bytes:' .. owner) or '0')
+    if info and info[2] == owner then
+        used = used - tonumber(info[3])
+    end
+    if limit >= 0 and used + size > limit then
+        return {0, owner, used, limit, false}
+    end
+    if info then
+        local oldsize = tonumber(info[3])
+        redis.call('HINCRBY', KEYS[1], 'objtype:keys:'  .. info[1], -1)
+        redis.call('HINCRBY', KEYS[1], 'objtype:bytes:' .. info[1], -oldsize)
+        redis.call('HINCRBY', KEYS[1], 'owner:keys:'    .. info[2], -1)
+        redis.call('HINCRBY', KEYS[1], 'owner:bytes:'   .. info[2], -oldsize)
+    end
+    redis.call('HSET', KEYS[2], ARGV[1], cjson.encode({ARGV[2], owner, ARGV[5]}))
+    redis.call('HINCRBY', KEYS[1], 'objtype:keys:'  .. ARGV[2], 1)
+    redis.call('HINCRBY', KEYS[1], 'objtype:bytes:' .. ARGV[2], size)
+    redis.call('HINCRBY', KEYS[1], 'owner:keys:'    .. owner, 1)
+    redis.call('HINCRBY', KEYS[1], 'owner:bytes:'   .. owner, size)
+    return {1, owner, used, limit, old or false}
+    """
+
+    def __init__(self, client):
+        self.redis   = client
+        self.update  = client.register_script(self.script)
+        self.reserveupdate = client.register_script(self.reservescript)
+        return
+
+
+    def keyinfo(self, key):
+        ''' Return (size, owner) for a key, or None if it is not recorded '''
+        info = self.redis.hget(keyinfo_key, key)
+        if info is None: return None
+        objtype, owner, size = json.loads(info)
+        return int(size), owner
+
+
+    def owners(self):
+        ''' Return a dict of key -> owner '''
+        return {key.decode():json.loads(info)[1] for key,info in self.redis.hscan_iter(keyinfo_key)}
+
+
+    def account(self, key, objtype, size, owner):
+        ''' Record that a key now has the given size (None if deleted), type, and owner '''
+        self.update(keys=[usage_key, keyinfo_key], args=[key, objtype, owner, '' if size is None else str(size)])
+        return
+
+
+    def reserve(self, key, objtype, size, owner, defaultowner, quota):
+        '''
+        Like account(), but first check that the owner (if None, the key's current owner,
+        or else defaultowner) stays within their quota (from a dict of owner -> bytes, with
+        '*' for anyone else), all in one atomic step. Returns (ok, owner, bytes used by the
+        owner not counting this key, their quota or None, and the previous (objtype, size,
+        owner) of the key or None), and only updates the counters if ok.
+        '''
+        args = [key, objtype, owner or '', '0' if owner is None else '1', str(size), json.dumps(quota), defaultowner]
+        ok, owner, used, limit, old = self.reserveupdate(keys=[usage_key, keyinfo_key], args=args)
+        owner = owner.decode() if isinstance(owner, bytes) else owner
+        previous = None
+        if old is not None:
+            oldtype, oldowner, oldsize = json.loads(old)
+            previous = (oldtype, int(oldsize), oldowner)
+        return bool(ok), owner, int(used), (None if limit < 0 else int(limit)), previous
+
+
+    def usage(self):
+        ''' Return a dict of kind -> name -> {'keys', 'bytes'} '''
+        output = {'objtype':{}, 'owner':{}}
+        for field,value in self.redis.hgetall(usage_key).items():
+            kind, which, name = field.decode().split(':', 2)
+            output[kind].setdefault(name, {'keys':0, 'bytes':0})[which] = int(value)
+        return output
+
+
+    def usagefor(self, kind, name):
+        ''' Return {'keys', 'bytes'} for one objtype or owner '''
+        keys, nbytes = self.redis.hmget(usage_key, ['%s:keys:%s' % (kind, name), '%s:bytes:%s' % (kind, name)])
+        return {'keys':int(keys or 0), 'bytes':int(nbytes or 0)}
+
+
+    def replace(self, entries):
+        ''' Replace all the accounting with a list of (key, objtype, size, owner) entries '''
+        keyinfo = {}
+        counters = collections.defaultdict(int)
+        for key,objtype,size,owner in entries:
+            keyinfo[key] = json.dumps([objtype, owner, str(size)])
+            for kind,name in [('objtype', objtype), ('owner', owner)]:
+                counters['%s:keys:%s' % (kind, name)] += 1
+                counters['%s:bytes:%s' % (kind, name)] += size
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(usage_key, keyinfo_key)
+        if keyinfo:
+            pipe.hset(keyinfo_key, mapping=keyinfo)
+            pipe.hset(usage_key, mapping=dict(counters))
+        pipe.execute()
+        return
+
+
+    def clear(self):
+        self.redis.delete(usage_key, keyinfo_key)
+        return
+
+
+class SQLAccounting(sc.prettyobj):
+    '''
+    Storage accounting for SQLDataStore (in the same database) and FileDataStore (in a
+    SQLite file next to the folder), kept in two tables: the counters, and the size,
+    type, and owner of each key. Each update is a single transaction that touches a
+    handful of rows by primary key.
+    '''
+
+    def __init__(self, engine):
+        from sqlalchemy.ext.declarative import declarative_base
+        Base = declarative_base()
+
+        class SQLUsage(Base):
+            __tablename__ = 'datastore_usage'
+            kind   = sqlalchemy.Column('kind', sqlalchemy.types.String(length=16), primary_key=True)
+            name   = sqlalchemy.Column('name', sqlalchemy.types.String(length=max_key_length), primary_key=True)
+            nkeys  = sqlalchemy.Column('keys', sqlalchemy.types.BigInteger, default=0)
+            nbytes = sqlalchemy.Column('bytes', sqlalchemy.types.BigInteger, default=0)
+
+        class SQLKeyInfo(Base):
+            __tablename__ = 'datastore_keyinfo'
+            key     = sqlalchemy.Column('key', sqlalchemy.types.String(length=max_key_length), primary_key=True)
+            objtype = sqlalchemy.Column('objtype', sqlalchemy.types.String(length=max_key_length))
+            owner   = sqlalchemy.Column('owner', sqlalchemy.types.String(length=max_key_length))
+            size    = sqlalchemy.Column('size', sqlalchemy.types.BigInteger)
+
+        self.usagetype   = SQLUsage
+        self.keyinfotype = SQLKeyInfo
+        self.engine      = engine
+        Base.metadata.create_all(engine)
+        self.get_session = sqlalchemy.orm.session.sessionmaker(bind=engine)
+        return
+
+
+    def keyinfo(self, key):
+        session = self.get_session()
+        info = session.get(self.keyinfotype, key)
+        session.close()
+        return None if info is None else (info.size, info.owner)
+
+
+    def owners(self):
+        session = self.get_session()
+        output = dict(session.query(self.keyinfotype.key, self.keyinfotype.owner).all())
+        session.close()
+        return output
+
+
+    def _update(self, session, info, key, objtype, size, owner):
+        ''' Record the new size (None if deleted), type, and owner of a key, given its keyinfo row (or None), in a session '''
+        deltas = collections.defaultdict(lambda: [0, 0])
+        if info is not None:
+            for kind,name in [('objtype', info.objtype), ('owner', info.owner)]:
+                deltas[(kind, name)][0] -= 1
+                deltas[(kind, name)][1] -= info.size
+        if size is None:
+            if info is not None:
+                session.delete(info)
+        else:
+            if info is None:
+                info = self.keyinfotype(key=key)
+                session.add(info)
+            info.objtype, info.owner, info.size = objtype, owner, size
+            for kind,name in [('objtype', objtype), ('owner', owner)]:
+                deltas[(kind, name)][0] += 1
+                deltas[(kind, name)][1] += size
+        for (kind,name),(dkeys,dbytes) in deltas.items():
+            if not dkeys and not dbytes: continue
+            usage = self.usagetype
+            updated = session.query(usage).filter(usage.kind==kind, usage.name==name).update({usage.nkeys:usage.nkeys+dkeys, usage.nbytes:usage.nbytes+dbytes}, synchronize_session=False)
+            if not updated:
+                session.add(usage(kind=kind, name=name, nkeys=dkeys, nbytes=dbytes))
+        session.flush()
+        return
+
+
+    def account(self, key, objtype, size, owner):
+        for attempt in range(3): # Two new counters can race to be inserted; if so, try again
+            session = self.get_session()
+            try:
+                self._update(session, session.get(self.keyinfotype, key), key, objtype, size, owner)
+                session.commit()
+                return
+            except sqlalchemy.exc.IntegrityError:
+                session.rollback()
+                if attempt == 2: raise
+            finally:
+                session.close()
+
+
+    def reserve(self, key, objtype, size, owner, defaultowner, quota):
+        ''' See RedisAccounting.reserve(); the counters are updated first, which locks them, then checked, and rolled back if over quota '''
+        for attempt in range(3):
+            session = self.get_session()
+            try:
+                info = session.get(self.keyinfotype, key, with_for_update=True)
+                previous = None if info is None else (info.objtype, info.size, info.owner)
+                if owner is None:
+                    owner = info.owner if info is not None else defaultowner
+                limit = quota.get(owner, quota.get('*')) if owner else None
+                self._update(session, info, key, objtype, size, owner)
+                used = None
+                if limit is not None:
+                    used = session.get(self.usagetype, ('owner', owner), populate_existing=True).nbytes - size
+                    if used + size > limit:
+                        session.rollback()
+                        return False, owner, used, limit, previous
+                session.commit()
+                return True, owner, used, limit, previous
+            except sqlalchemy.exc.IntegrityError:
+                session.rollback()
+                if attempt == 2: raise
+            finally:
+                session.close()
+
+
+    def usage(self):
+        session = self.get_session()
+        output = {'objtype':{}, 'owner':{}}
+        for row in session.query(self.usagetype).all():
+            output[row.kind][row.name] = {'keys':row.nkeys, 'bytes':row.nbytes}
+        session.close()
+        return output
+
+
+    def usagefor(self, kind, name):
+        session = self.get_session()
+        row = session.get(self.usagetype, (kind, name))
+        session.close()
+        return {'keys':0, 'bytes':0} if row is None else {'keys':row.nkeys, 'bytes':row.nbytes}
+
+
+    def replace(self, entries):
+        counters = collections.defaultdict(lambda: [0, 0])
+        for key,objtype,size,owner in entries:
+            for kind,name in [('objtype', objtype), ('owner', owner)]:
+                counters[(kind, name)][0] += 1
+                counters[(kind, name)][1] += size
+        session = self.get_session()
+        session.query(self.keyinfotype).delete()
+        session.query(self.usagetype).delete()
+        session.bulk_insert_mappings(self.keyinfotype, [dict(key=key, objtype=objtype, size=size, owner=owner) for key,objtype,size,owner in entries])
+        session.bulk_insert_mappings(self.usagetype, [dict(kind=kind, name=name, nkeys=nkeys, nbytes=nbytes) for (kind,name),(nkeys,nbytes) in counters.items()])
+        session.commit()
+        session.close()
+        return
+
+
+    def clear(self):
+        self.replace([])
+        return
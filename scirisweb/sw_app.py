@@ -6,13 +6,18 @@ ScirisWeb wrapper for a Flask app
 import io
 import os
 import sys
+import time
+import json as stdjson
 import socket
 import logging
+import struct
 import traceback
-from collections import OrderedDict
-from functools import wraps
+import msgspec
+import numpy as np
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, abort, json, jsonify as flask_jsonify, send_from_directory, make_response, current_app as flaskapp, send_file
+from flask import Flask, request, abort, g, json, jsonify as flask_jsonify, send_from_directory, make_response, current_app as flaskapp, send_file, stream_with_context, copy_current_request_context
 from flask_login import LoginManager, current_user
 from flask_cors import CORS
 
@@ -32,37 +37,161 @@ import sciris as sc
 from . import sw_datastore as ds
 from . import sw_rpcs as rpcs
 from . import sw_tasks as tasks
+from . import sw_tempspace as ts
 from . import sw_users as users
 
 #################################################################
 ### Classes and functions
 #################################################################
 
-__all__ = ['robustjsonify', 'ScirisApp', 'ScirisResource', 'flaskapp']
+__all__ = ['robustjsonify', 'packresult', 'unpackresult', 'ScirisApp', 'ScirisResource', 'flaskapp']
+
+msgpack_mimetypes = ['application/msgpack', 'application/x-msgpack']
+arrays_mimetype   = 'application/vnd.sciris.arrays' # JSON header followed by the raw array buffers; see packresult()
+rpc_mimetypes     = ['application/json'] + msgpack_mimetypes + [arrays_mimetype] # Formats an RPC result can be sent in, JSON first so it is the default
+stream_mimetypes  = ['application/x-ndjson', 'application/json'] # Formats a stream RPC can be sent in; see ScirisApp._stream_response()
+array_kinds       = 'biufc' # NumPy dtype kinds sent as raw buffers by the binary formats
+array_alignment   = 64 # Byte alignment of the buffers in the arrays format, so clients can view them as typed arrays without copying
+
+def _jsonhook(obj):
+    ''' Convert the objects that the JSON encoder doesn't handle itself, as sc.sanitizejson() would '''
+    if isinstance(obj, np.ndarray):
+        return obj.reshape(-1).tolist() if not obj.shape else obj.tolist() # Converted in one go rather than elementwise; NaNs become null
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, complex):
+        return str(obj) # JSON has no complex type
+    output = sc.sanitizejson(obj) # E.g. objects with a to_json() method
+    if type(output) is type(obj): # E.g. a dict key of None, which can't be converted here
+        raise TypeError('Cannot encode %s as JSON' % type(obj))
+    return output
+
+
+json_encoder = msgspec.json.Encoder(enc_hook=_jsonhook, decimal_format='number')
+
+
+@lru_cache(maxsize=None)
+def _logtemplate(color, enable):
+    ''' A format string that colors a log message, worked out once rather than by sc.colorize() on every call '''
+    return sc.colorize(list(color), '%s', output=True, doprint=False, enable=enable)
+
 
 def robustjsonify(response, fallback=False, verbose=True):
     ''' 
-    Flask's default jsonifier clobbers dict order; this preserves it; however, it falls 
-    back to regular Flask jsonify if needed.
+    Convert an RPC result to a JSON response in a single pass, preserving dict order.
+    NumPy arrays and scalars, datetimes (as ISO 8601 strings), sets, tuples, and odicts
+    are encoded directly, with NaN and infinite values as null; other objects are
+    converted via sc.sanitizejson(). With fallback=True, use regular Flask jsonify instead.
     '''
-    robustjson = sc.sanitizejson(response, tostring=True) + '\n' # The newline is part of Flask: https://github.com/pallets/flask/issues/1877
-    lenjson = len(robustjson)
-    placeholder = '_'*(lenjson-3) # Create a placeholder of the correct length -- -3 because of ""\n which gets added
-    flaskjson = flask_jsonify(placeholder) # Use standard Flask jsonification
-    lenplaceholder = len(flaskjson.response[0])
-    if lenplaceholder == lenjson: # Lengths match, proceed
-        flaskjson.response[0] = robustjson 
-    else: # If there's a length mismatch, fall back to regular Flask
-        if verbose: print('ScirisApp: not robustifying JSON since length mismatch (%s vs. %s): %s' % (lenjson, len(flaskjson.response[0]), robustjson))
-        fallback = True
+    if not fallback:
+        try:
+            output = json_encoder.encode(response)
+        except (TypeError, ValueError, msgspec.EncodeError): # E.g. dicts with keys other than strings and numbers
+            try:
+                output = json_encoder.encode(sc.sanitizejson(response))
+            except Exception as E:
+                if verbose: print('ScirisApp: falling back to Flask jsonify, since encoding failed: %s' % str(E))
+                fallback = True
     if fallback: # Use standard Flask jsonification if anything went wrong
         try:
-            flaskjson = flask_jsonify(sc.sanitizejson(response)) 
+            return flask_jsonify(sc.sanitizejson(response)) 
         except Exception as E:
             errormsg = 'Flask jsonification of "%s" failed: %s' % (response, str(E))
             exc = type(E)
             raise exc(errormsg) from E
-    return flaskjson
+    return flaskapp.response_class(output + b'\n', mimetype='application/json') # The newline is part of Flask: https://github.com/pallets/flask/issues/1877
+
+
+def _jsonchunk(obj):
+    ''' Encode one item of a streamed result as JSON, as for robustjsonify() '''
+    try:
+        return json_encoder.encode(obj)
+    except (TypeError, ValueError, msgspec.EncodeError):
+        return json_encoder.encode(sc.sanitizejson(obj))
+
+
+def _littleendian(arr):
+    ''' A C-contiguous, little-endian version of a numeric array (the array itself if it already is one) '''
+    return np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<'))
+
+
+def _msgpackhook(obj):
+    ''' Convert the objects that the msgpack encoder doesn't handle itself: numeric arrays become raw buffers '''
+    if isinstance(obj, np.ndarray) and obj.dtype.kind in array_kinds:
+        arr = _littleendian(obj)
+        return {'__ndarray__':arr.dtype.str, 'shape':list(arr.shape), 'data':memoryview(arr).cast('B')}
+    return _jsonhook(obj)
+
+
+msgpack_encoder = msgspec.msgpack.Encoder(enc_hook=_msgpackhook, decimal_format='number')
+
+
+def packresult(result, mimetype=None):
+    '''
+    Encode an RPC result in a binary format, with numeric NumPy arrays sent as raw
+    little-endian buffers rather than as lists of numbers. Other values are converted
+    as for `robustjsonify()`.
+
+    Formats:
+        'application/msgpack' (or 'application/x-msgpack'): MessagePack, with each array as
+            a map {"__ndarray__": dtype, "shape": [...], "data": <bin>}, e.g. dtype "<f8"
+        'application/vnd.sciris.arrays': an 8-byte little-endian header length, the header
+            as JSON, and then the array buffers, each starting on a 64-byte boundary. In the
+            header, each array is {"__ndarray__": dtype, "shape": [...], "offset": offset,
+            "nbytes": nbytes}, where the offset is from the start of the first buffer, i.e.
+            from the end of the header rounded up to 64 bytes.
+
+    Use `unpackresult()` to decode either format in Python.
+    '''
+    if mimetype is None: mimetype = msgpack_mimetypes[0]
+    if mimetype in msgpack_mimetypes:
+        return msgpack_encoder.encode(result)
+    elif mimetype != arrays_mimetype:
+        errormsg = 'Cannot pack an RPC result as "%s"; choices are: %s' % (mimetype, rpc_mimetypes[1:])
+        raise ValueError(errormsg)
+
+    buffers = []
+    nbytes = 0
+    def hook(obj):
+        nonlocal nbytes
+        if isinstance(obj, np.ndarray) and obj.dtype.kind in array_kinds:
+            arr = _littleendian(obj)
+            nbytes += -nbytes % array_alignment
+            buffers.append((nbytes, arr))
+            output = {'__ndarray__':arr.dtype.str, 'shape':list(arr.shape), 'offset':nbytes, 'nbytes':arr.nbytes}
+            nbytes += arr.nbytes
+            return output
+        return _jsonhook(obj)
+    header = msgspec.json.Encoder(enc_hook=hook, decimal_format='number').encode(result)
+    start = 8 + len(header)
+    start += -start % array_alignment
+    output = bytearray(start + nbytes)
+    struct.pack_into('<Q', output, 0, len(header))
+    output[8:8+len(header)] = header
+    for offset,arr in buffers:
+        output[start+offset:start+offset+arr.nbytes] = memoryview(arr).cast('B')
+    return bytes(output)
+
+
+def unpackresult(data, mimetype=None):
+    ''' Decode an RPC result encoded by `packresult()`, turning the arrays back into NumPy arrays '''
+    if mimetype is None: mimetype = msgpack_mimetypes[0]
+    def toarray(obj, buffer=None):
+        if isinstance(obj, dict):
+            if '__ndarray__' in obj:
+                if buffer is None: flat = np.frombuffer(obj['data'], dtype=obj['__ndarray__'])
+                else:              flat = np.frombuffer(buffer, dtype=obj['__ndarray__'], count=obj['nbytes']//np.dtype(obj['__ndarray__']).itemsize, offset=obj['offset'])
+                return flat.reshape(obj['shape'])
+            return {k:toarray(v, buffer) for k,v in obj.items()}
+        elif isinstance(obj, list):
+            return [toarray(v, buffer) for v in obj]
+        return obj
+    if mimetype in msgpack_mimetypes:
+        return toarray(msgspec.msgpack.decode(data))
+    headerlen, = struct.unpack_from('<Q', data, 0)
+    start = 8 + headerlen
+    start += -start % array_alignment
+    return toarray(msgspec.json.decode(data[8:8+headerlen]), buffer=memoryview(data)[start:])
 
 
 class ScirisApp(sc.prettyobj):
@@ -131,9 +260,12 @@ class ScirisApp(sc.prettyobj):
         self._init_logger() # Initialize the Flask logger. 
         self._set_config_defaults() # Set up default values for configs that are not already defined.
         self._update_config_defaults(**kwargs) # If additional command-line arguments are supplied, use them
+        self.batch_pool = ThreadPoolExecutor(max_workers=self.config['RPC_BATCH_WORKERS'], thread_name_prefix='rpc-batch') # For batches run in parallel; threads are only started when needed
         self.define_endpoint_callback = self.flask_app.route # Set an alias for the decorator factory for adding an endpoint.
         self.endpoint_layout_dict = {} # Create an empty layout dictionary.
         self.RPC_dict = {}  # Create an empty RPC dictionary.
+        self.RPC_handlers = {} # Handlers compiled from the RPCs by _compile_RPC(), keyed by name
+        self.flask_app.after_request(self._cache_headers) # Keep browsers from caching responses, unless the RPC has an HTTP cache policy
         
         # Set up file paths.
         self._init_file_dirs()
@@ -170,6 +302,7 @@ class ScirisApp(sc.prettyobj):
             
             self.login_manager.init_app(self.flask_app) # Configure Flask app for login with the LoginManager.
             self.add_RPC_dict(users.RPC_dict) # Register the RPCs in the users.py module.
+            self.add_RPC_dict(ds.RPC_dict) # Register the admin RPCs in the datastore.py module -- these require users for validation
             
         # If we are including DataStore and tasks, initialize them.    
         if self.config['USE_DATASTORE'] and self.config['USE_TASKS']:
@@ -192,6 +325,15 @@ class ScirisApp(sc.prettyobj):
         if 'MATPLOTLIB_BACKEND' not in self.config: self.config['MATPLOTLIB_BACKEND'] = 'Agg'
         if 'SLACK'              not in self.config: self.config['SLACK']              = None
         if 'CORS'               not in self.config: self.config['CORS']               = False
+        if 'DATASTORE_WRITEBEHIND' not in self.config: self.config['DATASTORE_WRITEBEHIND'] = None # Seconds between background flushes of buffered writes, if any
+        if 'DATASTORE_ARGS'     not in self.config: self.config['DATASTORE_ARGS']     = None # Extra keyword arguments for make_datastore(), e.g. {'timeout':10, 'breaker':{'threshold':3}}
+        if 'DATASTORE_IDENTITY_MAP' not in self.config: self.config['DATASTORE_IDENTITY_MAP'] = False # Whether repeated reads of a key in one request return the same object, without going back to the datastore
+        if 'TEMP_QUOTA'         not in self.config: self.config['TEMP_QUOTA']         = None # Maximum size of the temp folder in bytes
+        if 'TEMP_USER_QUOTA'    not in self.config: self.config['TEMP_USER_QUOTA']    = None # Maximum size of each user's temp subfolder in bytes
+        if 'TEMP_MAX_AGE'       not in self.config: self.config['TEMP_MAX_AGE']       = None # Seconds after which unused temp files are removed
+        if 'TEMP_SWEEP_INTERVAL' not in self.config: self.config['TEMP_SWEEP_INTERVAL'] = None # Seconds between background sweeps of the temp folder
+        if 'RPC_BATCH_WORKERS'  not in self.config: self.config['RPC_BATCH_WORKERS']  = 4 # Threads shared by all batches of RPCs run in parallel
+        if 'RPC_BATCH_MAX'      not in self.config: self.config['RPC_BATCH_MAX']      = 100 # Maximum number of calls in a batch
         return
     
     def _update_config_defaults(self, **kwargs):
@@ -225,7 +367,9 @@ class ScirisApp(sc.prettyobj):
     def _init_datastore(self, use_db=True):
         if use_db:
             # Create the DataStore object
-            self.datastore = ds.make_datastore(url=self.config['DATASTORE_URL'])
+            datastore_args = dict(identitymap=self.config['DATASTORE_IDENTITY_MAP'])
+            datastore_args.update(self.config['DATASTORE_ARGS'] or {})
+            self.datastore = ds.make_datastore(url=self.config['DATASTORE_URL'], writebehind=self.config['DATASTORE_WRITEBEHIND'], **datastore_args)
             
             if self.config['LOGGING_MODE'] == 'FULL':
                 maxkeystoshow = 20
@@ -241,6 +385,10 @@ class ScirisApp(sc.prettyobj):
                     print('  Key %02i: %s' % (k,key))
         else:
             self.datastore = ds.DataDir() # Initialize with a simple temp data directory instead
+        
+        # Manage the temp folder, e.g. for uploads and downloads
+        tempconfig = dict(quota=self.config['TEMP_QUOTA'], userquota=self.config['TEMP_USER_QUOTA'], maxage=self.config['TEMP_MAX_AGE'], interval=self.config['TEMP_SWEEP_INTERVAL'])
+        self.datastore.tempspace = ts.TempSpace(self.datastore.tempfolder, **tempconfig)
         return
     
     def _init_tasks(self):
@@ -358,7 +506,8 @@ class ScirisApp(sc.prettyobj):
     def add_RPC(self, new_RPC):
         # If we are setting up our first RPC, add the actual endpoint.
         if len(self.RPC_dict) == 0:
-            self.flask_app.add_url_rule('/rpcs', 'do_RPC', self._do_RPC, methods=['POST'])
+            self.flask_app.add_url_rule('/rpcs', 'do_RPC', self._do_RPC, methods=['GET', 'POST']) # GET only for RPCs with an HTTP cache policy
+            self.flask_app.add_url_rule('/rpcs/batch', 'do_RPC_batch', self._do_RPC_batch, methods=['POST'])
           
         # If the function name is in the dictionary...
         if new_RPC.funcname in self.RPC_dict:
@@ -377,8 +526,9 @@ class ScirisApp(sc.prettyobj):
                       (new_RPC.funcname, self.RPC_dict[new_RPC.funcname].call_func.__module__, self.RPC_dict[new_RPC.funcname].funcname))
                 return
         
-        # Create the RPC and add it to the dictionary.
+        # Create the RPC and add it to the dictionary, along with its compiled handler.
         self.RPC_dict[new_RPC.funcname] = new_RPC
+        self.RPC_handlers[new_RPC.funcname] = (new_RPC, self._compile_RPC(new_RPC))
     
     def add_RPC_dict(self, new_RPC_dict):
         for RPC_funcname in new_RPC_dict:
@@ -394,6 +544,7 @@ class ScirisApp(sc.prettyobj):
             # Create the RPC and try to add it to the dictionary.
             new_RPC = rpcs.ScirisRPC(RPC_func, **callerkwargs)
             self.add_RPC(new_RPC)
+            wrapper.cache = new_RPC.cache # So the RPC can be invalidated via the function, e.g. myrpc.cache.invalidate()
             
             return wrapper
 
@@ -412,14 +563,21 @@ class ScirisApp(sc.prettyobj):
         # Check to see whether the RPC is getting passed in in request.form.
         # If so, we are doing an upload, and we want to download the RPC 
         # request info from the form, not request.data.
-        if 'funcname' in request.form: # Pull out the function name, args, and kwargs
+        if request.method == 'GET': # A cacheable RPC, with the function name, args, and kwargs in the query string
+            fn_name = request.args.get('funcname')
+            try:
+                args = stdjson.loads(request.args.get('args', '[]'))
+                kwargs = stdjson.loads(request.args.get('kwargs', '{}'))
+            except ValueError:
+                abort(400)
+        elif 'funcname' in request.form: # Pull out the function name, args, and kwargs
             fn_name = request.form.get('funcname')
-            try:    args = json.loads(request.form.get('args', "[]"), object_pairs_hook=OrderedDict)
+            try:    args = stdjson.loads(request.form.get('args', "[]"))
             except: args = [] # May or may not be present
-            try:    kwargs = json.loads(request.form.get('kwargs', "{}"), object_pairs_hook=OrderedDict)
+            try:    kwargs = stdjson.loads(request.form.get('kwargs', "{}"))
             except: kwargs = {} # May or may not be present
         else: # Otherwise, we have a normal or download RPC, which means we pull the RPC request info from request.data.
-            reqdict = json.loads(request.data, object_pairs_hook=OrderedDict)
+            reqdict = stdjson.loads(request.get_data()) # Dicts keep their order, so no need for an OrderedDict hook
             fn_name = reqdict['funcname']
             args = reqdict.get('args', [])
             kwargs = reqdict.get('kwargs', {})
@@ -430,173 +588,433 @@ class ScirisApp(sc.prettyobj):
             print('   kwargs: %s' % kwargs)
         
         # If the function name is not in the RPC dictionary, return an error.
-        if not sc.isstring(fn_name) :
+        if not isinstance(fn_name, str):
             return robustjsonify({'error': 'Invalid RPC - must be a string (%s)' % fn_name})
 
-        if not fn_name in self.RPC_dict:
+        found_RPC = self.RPC_dict.get(fn_name)
+        if found_RPC is None:
             return robustjsonify({'error': 'Could not find requested RPC "%s"' % fn_name})
+        if request.method == 'GET' and found_RPC.httpcache is None: # Only RPCs that are safe to cache may be called with GET
+            abort(405)
         
-        found_RPC = self.RPC_dict[fn_name] # Get the RPC we've found.
-        
-        ## Do any validation checks we need to do and return errors if they don't pass.
-        
-        # If the RPC is disabled, always return a Status 403 (Forbidden)
-        if found_RPC.validation == 'disabled':
-            if verbose: print('RPC(): RPC disabled')
-            abort(403)
-        
+        return self._RPC_handler(found_RPC)(args, kwargs, verbose)
+
+    def _RPC_handler(self, found_RPC):
+        ''' Get the handler compiled for this RPC by add_RPC(), or compile it now if the RPC was added some other way '''
+        compiled = self.RPC_handlers.get(found_RPC.funcname)
+        if compiled is None or compiled[0] is not found_RPC:
+            compiled = self.RPC_handlers[found_RPC.funcname] = (found_RPC, self._compile_RPC(found_RPC))
+        return compiled[1]
+
+    def _compile_RPC(self, found_RPC):
+        '''
+        Build the function that handles calls to an RPC. Validation, upload and download
+        handling, and the response are all worked out here once, when the RPC is added,
+        rather than on every call; the current user is only looked up if the validation
+        or the log message needs it.
+        '''
+        call_func = found_RPC.call_func
+        upload    = found_RPC.call_type == 'upload'
+        stream    = found_RPC.call_type == 'stream' # Logged when the stream ends, by _stream_response()
+        validate  = self._RPC_validator(found_RPC.validation)
+        respond   = {'download':self._download_response, 'stream':self._stream_response}.get(found_RPC.call_type, self._result_response)
+        cache     = found_RPC.cache
+        httpcache = found_RPC.httpcache
+        if cache is not None:
+            if cache.store == 'datastore' and cache.datastore is None and not self.config['USE_DATASTORE']:
+                errormsg = 'RPC %s() caches its results in the datastore, but this app has no datastore' % found_RPC.funcname
+                raise ValueError(errormsg)
+            def call_func(*args, **kwargs):
+                found, result, key = cache.get(args, kwargs)
+                if not found:
+                    result = found_RPC.call_func(*args, **kwargs)
+                    if not (isinstance(result, dict) and 'error' in result): # Don't cache errors
+                        cache.set(key, result)
+                return result
+
+        def handler(args, kwargs, verbose=False):
+            if validate is not None:
+                validate()
+            uploaded_fname = None
+            if upload:
+                uploaded_fname = self._receive_upload(verbose)
+                if not isinstance(uploaded_fname, str): # An error response
+                    return uploaded_fname
+                args = [uploaded_fname] + list(args) # Prepend the file name to the args list.
+            logging = self.config['LOGGING_MODE'] == 'FULL'
+            if logging:
+                self._log_RPC(found_RPC, 'called')
+            etag = None
+            if httpcache is not None:
+                g.sw_httpcache = True # So _cache_headers() leaves the headers alone
+                try:
+                    etag = httpcache.version(found_RPC.funcname, args, kwargs)
+                except Exception as E:
+                    return self._RPC_exception(found_RPC, E)
+                if etag is not None and etag in request.if_none_match: # The client's copy is current, so don't even run the RPC
+                    if logging: self._log_RPC(found_RPC, 'not modified')
+                    return httpcache.apply(flaskapp.response_class(status=304), etag)
+
+            # Execute the function to get the results, putting it in a try block in case there are errors in what's being called.
+            try:
+                if verbose: print('RPC(): Starting RPC...')
+                t0 = time.perf_counter()
+                result = call_func(*args, **kwargs)
+                if isinstance(result, dict) and 'error' in result: # If the RPC returns an error, return it
+                    g.sw_httpcache = False
+                    return robustjsonify({'error':result['error']})
+                if logging and not stream:
+                    self._log_RPC(found_RPC, 'finished in %0.2f s' % (time.perf_counter() - t0))
+            except Exception as E:
+                if verbose: print('RPC(): Exception encountered...')
+                g.sw_httpcache = False
+                return self._RPC_exception(found_RPC, E)
+            finally:
+                if uploaded_fname is not None: # Erase the physical uploaded file, since it is no longer needed (unless moved by the RPC)
+                    self.datastore.tempspace.release(uploaded_fname)
+                    if verbose: print('RPC(): Removed uploaded file: %s' % uploaded_fname)
+            output = respond(result, found_RPC, verbose)
+            if httpcache is not None:
+                output = httpcache.apply(make_response(output), etag)
+                etag = output.get_etag()[0]
+                if etag is not None and etag in request.if_none_match: # Same body as the client's copy, so don't send it again
+                    output = httpcache.apply(flaskapp.response_class(status=304), etag)
+            return output
+
+        handler.validate = validate # For batches, which validate once and call the function directly
+        handler.call = call_func
+        return handler
+
+    def _do_RPC_batch(self, verbose=False):
+        '''
+        Run several normal RPCs in one request. The body is a list of calls, each a dict
+        with funcname, args, and kwargs, or a dict {'calls': [...], 'parallel': True} to
+        run them at the same time on the app's batch thread pool rather than one after the
+        other. The current user is loaded, and each level of validation checked, only once
+        for the whole batch. The response is a list with an item for each call, in order:
+        {'result': ...}, or {'error': ...} or {'exception': ...} if that call failed.
+        '''
+        try:
+            reqdict = stdjson.loads(request.get_data())
+        except ValueError:
+            abort(400)
+        if isinstance(reqdict, list):
+            reqdict = {'calls':reqdict}
+        calls = reqdict.get('calls') if isinstance(reqdict, dict) else None
+        parallel = reqdict.get('parallel', False) if isinstance(reqdict, dict) else False
+        if not isinstance(calls, list):
+            return robustjsonify({'error': 'Invalid RPC batch - must be a list of calls'})
+        maxcalls = self.config['RPC_BATCH_MAX']
+        if maxcalls and len(calls) > maxcalls:
+            return make_response(robustjsonify({'error': 'RPC batch has %s calls, but the maximum is %s' % (len(calls), maxcalls)}), 413) # Status 413 = Payload Too Large
+        if verbose: print('RPC(): batch of %s calls' % len(calls))
+
+        # Work out what to run for each call, checking each level of validation once
+        outputs = [None]*len(calls)
+        validated = {} # Validation level -> None if the user passes, or else the error for the calls that need it
+        jobs = []
+        for i,call in enumerate(calls):
+            try:
+                fn_name = call['funcname']
+                args = call.get('args', [])
+                kwargs = call.get('kwargs', {})
+            except (TypeError, KeyError, AttributeError):
+                outputs[i] = {'error': 'Invalid RPC - must be a dict with a funcname (%s)' % call}
+                continue
+            found_RPC = self.RPC_dict.get(fn_name) if isinstance(fn_name, str) else None
+            if found_RPC is None:
+                outputs[i] = {'error': 'Could not find requested RPC "%s"' % fn_name}
+                continue
+            if found_RPC.call_type != 'normal':
+                outputs[i] = {'error': 'Cannot run %s RPC "%s" in a batch' % (found_RPC.call_type, fn_name)}
+                continue
+            handler = self._RPC_handler(found_RPC)
+            if found_RPC.validation not in validated:
+                validated[found_RPC.validation] = None
+                if handler.validate is not None:
+                    try:
+                        handler.validate()
+                    except HTTPException as E:
+                        validated[found_RPC.validation] = {'error': '%s: %s' % (E.name, E.description), 'status': E.code}
+            if validated[found_RPC.validation] is not None:
+                outputs[i] = validated[found_RPC.validation]
+                continue
+            jobs.append((i, found_RPC, handler.call, args, kwargs))
+
+        # Run the calls
+        if parallel and len(jobs) > 1:
+            user = current_user._get_current_object() if hasattr(self, 'login_manager') else None # Load the user here, rather than in every thread
+            futures = [(i, self.batch_pool.submit(copy_current_request_context(self._batch_call), found_RPC, call, args, kwargs, user)) for i,found_RPC,call,args,kwargs in jobs]
+            for i,future in futures:
+                outputs[i] = future.result()
+        else:
+            for i,found_RPC,call,args,kwargs in jobs:
+                outputs[i] = self._batch_call(found_RPC, call, args, kwargs)
+        return self._result_response(outputs, None, verbose)
+
+    def _batch_call(self, found_RPC, call, args, kwargs, user=None):
+        ''' Run one call of a batch, and return its result, error, or exception as a dict '''
+        if user is not None:
+            g._login_user = user # Flask-Login's cache of the current user, which starts out empty in a worker thread's copy of the request context
+        logging = self.config['LOGGING_MODE'] == 'FULL'
+        if logging:
+            self._log_RPC(found_RPC, 'called')
+        try:
+            t0 = time.perf_counter()
+            result = call(*args, **kwargs)
+        except HTTPException as E: # E.g. abort() inside the RPC
+            return {'error': '%s: %s' % (E.name, E.description), 'status': E.code}
+        except Exception as E:
+            return {'exception': self._log_exception(found_RPC, E)}
+        if isinstance(result, dict) and 'error' in result:
+            return {'error': result['error']}
+        if logging:
+            self._log_RPC(found_RPC, 'finished in %0.2f s' % (time.perf_counter() - t0))
+        return {'result': result}
+
+    def _cache_headers(self, response):
+        ''' Keep the client browser from caching the response, and set it as already being "expired", unless an RPC's HTTP cache policy set the headers '''
+        if not g.get('sw_httpcache'):
+            response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+            response.headers['Expires'] = '0'
+        return response
+
+    def invalidate_RPC(self, funcname, args=None, kwargs=None, username=None):
+        ''' Remove cached results of an RPC: of one call if args or kwargs are given, else all of them (see RPCCache.invalidate()) '''
+        cache = self.RPC_dict[funcname].cache
+        if cache is None:
+            errormsg = 'RPC %s() does not cache its results' % funcname
+            raise ValueError(errormsg)
+        with self.flask_app.app_context(): # For caches in the datastore
+            return cache.invalidate(args=args, kwargs=kwargs, username=username)
+
+    def cache_stats(self):
+        ''' Hits, misses, and hit rate of each RPC that caches its results '''
+        return {name:RPC.cache.stats() for name,RPC in self.RPC_dict.items() if RPC.cache is not None}
+
+    def _RPC_validator(self, validation):
+        ''' Return a function that aborts the request if the current user may not call an RPC with this validation, or None if anyone may '''
+        if validation == 'disabled': # If the RPC is disabled, always return a Status 403 (Forbidden)
+            def validate():
+                abort(403)
+            return validate
+
         # Only do other validation if DataStore and users are included -- NOTE: Any "unknown" validation values are treated like 'none'.
-        if self.config['USE_DATASTORE'] and self.config['USE_USERS']:
-            if found_RPC.validation == 'any' and not (current_user.is_anonymous or current_user.is_authenticated):
-                abort(401) # If the RPC should be executable by any user, including an anonymous one, but there is no authorization or anonymous login, return a Status 401 (Unauthorized)
-            elif found_RPC.validation == 'named' and (current_user.is_anonymous or not current_user.is_authenticated):
-                abort(401) # Else if the RPC should be executable by any non-anonymous user, but there is no authorization or there is an anonymous login, return a Status 401 (Unauthorized)
-            elif found_RPC.validation == 'admin': # Else if the RPC should be executable by any admin user, but there is no admin login or it's an anonymous login...
+        if not (self.config['USE_DATASTORE'] and self.config['USE_USERS']):
+            return None
+        if validation == 'any':
+            def validate():
+                if not (current_user.is_anonymous or current_user.is_authenticated):
+                    abort(401) # If the RPC should be executable by any user, including an anonymous one, but there is no authorization or anonymous login, return a Status 401 (Unauthorized)
+        elif validation == 'named':
+            def validate():
+                if current_user.is_anonymous or not current_user.is_authenticated:
+                    abort(401) # If the RPC should be executable by any non-anonymous user, but there is no authorization or there is an anonymous login, return a Status 401 (Unauthorized)
+        elif validation == 'admin':
+            def validate():
                 if current_user.is_anonymous or not current_user.is_authenticated:
                     abort(401) # If the user is anonymous or no authenticated user is logged in, return Status 401 (Unauthorized).
                 elif not current_user.is_admin:
                     abort(403) # Else, if the user is not an admin user, return Status 403 (Forbidden).
-                    
-        # If we are doing an upload...
-        if found_RPC.call_type == 'upload':
-            if verbose: print('Starting upload...')
-            thisfile = request.files['uploadfile'] # Grab the formData file that was uploaded.    
-            filename = secure_filename(thisfile.filename) # Extract a sanitized filename from the one we start with.
-            try:
-                uploaded_fname = os.path.join(self.datastore.tempfolder, filename) # Generate a full upload path/file name.
-            except Exception as E:
-                exc = type(E)
-                errormsg = 'Could not create filename for uploaded file: %s' % str(E)
-                raise exc(errormsg) from E
+        else:
+            return None
+        return validate
+
+    def _RPC_info(self, found_RPC):
+        ''' The time, user, and full name of an RPC, for log messages '''
+        timestr = time.strftime('[%Y-%b-%d %H:%M:%S]') # As sc.now(astype='str'), which is much slower
+        userstr = g.get('sw_loguser') if g else None # Worked out once per request
+        if userstr is None:
             try:
-                thisfile.save(uploaded_fname) # Save the file to the uploads directory
-            except Exception as E:
-                exc = type(E)
-                errormsg = 'Could not save uploaded file: %s' % str(E)
-                raise exc(errormsg) from E
-            args.insert(0, uploaded_fname) # Prepend the file name to the args list.
-        
-        # Show the call of the function.
-        callcolor    = ['cyan',  'bgblue']
-        successcolor = ['green', 'bgblue']
-        failcolor    = ['gray',  'bgred']
-        timestr = '[%s]' % sc.now(astype='str')
-        try:    userstr = ' <%s>' % current_user.username
-        except: userstr =' <no user>'
-        RPCinfo = sc.objdict({'time':timestr, 'user':userstr, 'module':found_RPC.call_func.__module__, 'name':found_RPC.funcname})
-        
-        if self.config['LOGGING_MODE'] == 'FULL':
-            string = '%s%s RPC called: "%s.%s"' % (RPCinfo.time, RPCinfo.user, RPCinfo.module, RPCinfo.name)
-            sc.colorize(callcolor, string, enable=self.colorize)
-    
-        # Execute the function to get the results, putting it in a try block in case there are errors in what's being called. 
+                user = g.get('_login_user') # Already loaded by Flask-Login, if the RPC is validated
+                userstr = ' <%s>' % (user if user is not None else current_user).username
+            except:
+                userstr = ' <no user>'
+            if g: g.sw_loguser = userstr
+        return timestr, userstr, '%s.%s' % (found_RPC.call_func.__module__, found_RPC.funcname)
+
+    def _log_RPC(self, found_RPC, event):
+        ''' Show the call of the function, or its completion '''
+        timestr, userstr, name = self._RPC_info(found_RPC)
+        color = ('cyan', 'bgblue') if event == 'called' else ('green', 'bgblue')
+        print(_logtemplate(color, self.colorize) % ('%s%s RPC %s: "%s"' % (timestr, userstr, event, name)))
+        return
+
+    def _log_exception(self, found_RPC, E):
+        ''' Log an exception raised by an RPC, and return the message to send back to the client '''
+        timestr, userstr, name = self._RPC_info(found_RPC)
+        shortmsg = str(E)
+        exception = traceback.format_exc() # Grab the trackback stack
+        hostname = '|%s| ' % socket.gethostname()
+        tracemsg = '%s%s%s Exception during RPC "%s" \nRequest: %s \n%.10000s' % (hostname, timestr, userstr, name, request, exception)
+        sc.colorize(['gray', 'bgred'], tracemsg, enable=self.colorize) # Post an error to the Flask logger limiting the exception information to 10000 characters maximum (to prevent monstrous sqlalchemy outputs)
+        if self.config['SLACK']:
+            self.slacknotification(tracemsg)
+        return shortmsg + '\n\nException details:\n' + tracemsg
+
+    def _RPC_exception(self, found_RPC, E):
+        ''' Log an exception raised by an RPC, and convert it to a response with status 500 '''
+        fullmsg = self._log_exception(found_RPC, E)
+        if isinstance(E, HTTPException): # If we have a werkzeug exception, pass it on up to werkzeug to resolve and reply to.
+            raise E
+        code = 500 # Send back a response with status 500 that includes the exception traceback.
+        reply = {'exception':fullmsg} # NB, not sure how to actually access 'traceback' on the FE, but keeping it here for future
+        return make_response(robustjsonify(reply), code)
+
+    def _receive_upload(self, verbose=False):
+        ''' Save an uploaded file in the user's temp folder and return its path, or an error response if there is no room '''
+        if verbose: print('Starting upload...')
+        thisfile = request.files['uploadfile'] # Grab the formData file that was uploaded.    
+        filename = secure_filename(thisfile.filename) # Extract a sanitized filename from the one we start with.
+        tempspace = self.datastore.tempspace
         try:
-            if verbose: print('RPC(): Starting RPC...')
-            T = sc.tic()
-            result = found_RPC.call_func(*args, **kwargs)
-            if isinstance(result, dict) and 'error' in result: # If the RPC returns an error, return it
-                return robustjsonify({'error':result['error']})
-            elapsed = sc.toc(T, output=True)
-            if self.config['LOGGING_MODE'] == 'FULL':
-                string = '%s%s RPC finished in %0.2f s: "%s.%s"' % (RPCinfo.time, RPCinfo.user, elapsed, RPCinfo.module, RPCinfo.name)
-                sc.colorize(successcolor, string, enable=self.colorize)
+            tempspace.reserve(request.content_length or 0) # Make room for the file, evicting old temp files if needed
+        except ts.QuotaExceededError as E:
+            return make_response(robustjsonify({'error': str(E)}), 413) # Status 413 = Payload Too Large
+        try:
+            uploaded_fname = tempspace.path(filename) # Generate a full upload path/file name, in the user's temp folder
         except Exception as E:
-            if verbose: print('RPC(): Exception encountered...')
-            shortmsg = str(E)
-            exception = traceback.format_exc() # Grab the trackback stack
-            hostname = '|%s| ' % socket.gethostname()
-            tracemsg = '%s%s%s Exception during RPC "%s.%s" \nRequest: %s \n%.10000s' % (hostname, RPCinfo.time, RPCinfo.user, RPCinfo.module, RPCinfo.name, request, exception)
-            sc.colorize(failcolor, tracemsg, enable=self.colorize) # Post an error to the Flask logger limiting the exception information to 10000 characters maximum (to prevent monstrous sqlalchemy outputs)
-            if self.config['SLACK']:
-                self.slacknotification(tracemsg)
-            if isinstance(E, HTTPException): # If we have a werkzeug exception, pass it on up to werkzeug to resolve and reply to.
-                raise E
-            code = 500 # Send back a response with status 500 that includes the exception traceback.
-            fullmsg = shortmsg + '\n\nException details:\n' + tracemsg
-            reply = {'exception':fullmsg} # NB, not sure how to actually access 'traceback' on the FE, but keeping it here for future
-            return make_response(robustjsonify(reply), code)
-
-        # If we are doing a download, prepare the response and send it off.
-        if found_RPC.call_type == 'download':
-            # To download a file, use `this.$sciris.download` instead of `this.$sciris.rpc`. Decorate the RPC with
-            # `@RPC(call_type='download')`. Finally, the RPC needs to specify the file and optionally the filename.
-            # This is done with tuple unpacking. The following outputs are supported from `rpc_function()`
-            #
-            # 1 - filename_on_disk
-            # 2 - BytesIO
-            # 3 - filename_on_disk, download_filename
-            # 4- BytesIO, download_filename
-            #
-            # Examples return values from the RPC are as follows
-            #
-            # 1 - "E:/test.xlsx" (uses "test.xlsx")
-            # 2 - <BytesIO> (default filename will be generated in this function)
-            # 3 - ("E:/test.xlsx","foo.xlsx")
-            # 4 - (<BytesIO>,"foo.xlsx")
-            #
-            # On the RPC end, the most common cases would be it might look like
-            #
-            # return "E:/test.xlsx"
-            #
-            # OR
-            #
-            # return Blobject.to_file(), "foo.xlsx"
-
-            if verbose: print('RPC(): Starting download...')
-
-            if result is None: # If we got None for a result (the full file name), return an error to the client.
-                return robustjsonify({'error': 'Could not find resource to download from RPC "%s": result is None' % fn_name})
-            elif sc.isstring(result):
-                from_file = True
-                dir_name, file_name = os.path.split(result)
-                output_name = file_name
-            elif isinstance(result,io.BytesIO):
-                from_file = False
-                bytesio = result
-                output_name = 'download.obj'
-            else:
-                try:
-                    content = result[0]
-                    output_name = result[1]
-                    if sc.isstring(content):
-                        from_file = True
-                        dir_name, file_name = os.path.split(content)
-                    elif isinstance(content,io.BytesIO):
-                        from_file = False
-                        bytesio = content
-                    else:
-                        return robustjsonify({'error': 'Unrecognized RPC output'})
-                except Exception as E:
-                    return robustjsonify({'error': 'Error reading RPC result (%s)' % E})
-
-            if from_file:
-                response = send_from_directory(dir_name, file_name, as_attachment=True)
-                response.status_code = 201  # Status 201 = Created
-                # Unfortunately, we cannot remove the actual file at this point
-                # because it is in use during the actual download, so we rely on
-                # later cleanup to remove download files.
-            else:
-                response = send_file(bytesio, as_attachment=True, download_name=output_name)
-            response.headers['filename'] = output_name
-            print(response)
-            return response # Return the response message.
-
+            exc = type(E)
+            errormsg = 'Could not create filename for uploaded file: %s' % str(E)
+            raise exc(errormsg) from E
+        tempspace.pin(uploaded_fname) # Don't evict it until the RPC is done
+        try:
+            thisfile.save(uploaded_fname) # Save the file to the uploads directory
+        except Exception as E:
+            tempspace.release(uploaded_fname)
+            exc = type(E)
+            errormsg = 'Could not save uploaded file: %s' % str(E)
+            raise exc(errormsg) from E
+        return uploaded_fname
 
-        # Otherwise (normal and upload RPCs), 
-        else: 
-            if found_RPC.call_type == 'upload': # If we are doing an upload....
-                try:
-                    os.remove(uploaded_fname) # Erase the physical uploaded file, since it is no longer needed.
-                    if verbose: print('RPC(): Removed uploaded file: %s' % uploaded_fname)
-                except Exception as E:
-                    if verbose: print('RPC(): Could not remove uploaded file: %s' % str(E)) # Probably since moved by the user
-            if result is None: # If None was returned by the RPC function, return ''.
-                if verbose: print('RPC(): RPC finished, returning None')
-                return ''
-            else: # Otherwise, convert the result (probably a dict) to JSON and return it.
+    def _result_response(self, result, found_RPC, verbose=False):
+        ''' For normal and upload RPCs, convert the result (probably a dict) to JSON, or to a binary format if the client asks for one (see packresult()) '''
+        if result is None: # If None was returned by the RPC function, return ''.
+            if verbose: print('RPC(): RPC finished, returning None')
+            return ''
+        mimetype = request.accept_mimetypes.best_match(rpc_mimetypes, default=rpc_mimetypes[0]) if request.accept_mimetypes else rpc_mimetypes[0]
+        if mimetype == rpc_mimetypes[0]:
+            output = robustjsonify(result)
+        else:
+            try:
+                output = flaskapp.response_class(packresult(result, mimetype), mimetype=mimetype)
+            except (TypeError, ValueError, msgspec.EncodeError) as E: # E.g. dicts with keys msgpack can't hold
+                if verbose: print('RPC(): could not send result as %s, sending JSON instead: %s' % (mimetype, str(E)))
                 output = robustjsonify(result)
-                if verbose: print('RPC(): RPC finished, returning result')
-                return output
+        output.vary.add('Accept')
+        if verbose: print('RPC(): RPC finished, returning result')
+        return output
+
+    def _stream_response(self, result, found_RPC, verbose=False):
+        '''
+        For stream RPCs, send each item the RPC yields as soon as it is produced, rather
+        than building the whole result first. Items are sent as newline-delimited JSON
+        (application/x-ndjson), or as the elements of a JSON array if the client prefers
+        application/json. If the RPC raises an exception part way through, the last item
+        sent is {"exception": message}, since the status has already been sent.
+        '''
+        if result is None:
+            chunks = []
+        elif isinstance(result, (dict, str, bytes)): # A single item rather than an iterable of them
+            chunks = [result]
+        else:
+            chunks = result
+        mimetype = request.accept_mimetypes.best_match(stream_mimetypes, default=stream_mimetypes[0]) if request.accept_mimetypes else stream_mimetypes[0]
+        asarray = mimetype == 'application/json'
+        logging = self.config['LOGGING_MODE'] == 'FULL'
+
+        def generate():
+            t0 = time.perf_counter()
+            count = 0
+            if asarray: yield b'['
+            try:
+                for chunk in chunks:
+                    if asarray and count: yield b','
+                    yield _jsonchunk(chunk) + (b'' if asarray else b'\n')
+                    count += 1
+            except Exception as E:
+                if verbose: print('RPC(): Exception encountered while streaming...')
+                reply = {'exception':self._log_exception(found_RPC, E)}
+                if asarray and count: yield b','
+                yield _jsonchunk(reply) + (b'' if asarray else b'\n')
+            finally:
+                close = getattr(chunks, 'close', None) # Run the generator's cleanup if the client disconnects
+                if close is not None: close()
+            if asarray: yield b']\n'
+            if logging: self._log_RPC(found_RPC, 'streamed %s items in %0.2f s' % (count, time.perf_counter() - t0))
+            if verbose: print('RPC(): RPC finished streaming')
+
+        response = flaskapp.response_class(stream_with_context(generate()), mimetype=mimetype)
+        response.vary.add('Accept')
+        return response
+
+    def _download_response(self, result, found_RPC, verbose=False):
+        ''' For download RPCs, prepare the response that sends the file '''
+        # To download a file, use `this.$sciris.download` instead of `this.$sciris.rpc`. Decorate the RPC with
+        # `@RPC(call_type='download')`. Finally, the RPC needs to specify the file and optionally the filename.
+        # This is done with tuple unpacking. The following outputs are supported from `rpc_function()`
+        #
+        # 1 - filename_on_disk
+        # 2 - BytesIO
+        # 3 - filename_on_disk, download_filename
+        # 4- BytesIO, download_filename
+        #
+        # Examples return values from the RPC are as follows
+        #
+        # 1 - "E:/test.xlsx" (uses "test.xlsx")
+        # 2 - <BytesIO> (default filename will be generated in this function)
+        # 3 - ("E:/test.xlsx","foo.xlsx")
+        # 4 - (<BytesIO>,"foo.xlsx")
+        #
+        # On the RPC end, the most common cases would be it might look like
+        #
+        # return "E:/test.xlsx"
+        #
+        # OR
+        #
+        # return Blobject.to_file(), "foo.xlsx"
+
+        if verbose: print('RPC(): Starting download...')
+
+        if result is None: # If we got None for a result (the full file name), return an error to the client.
+            return robustjsonify({'error': 'Could not find resource to download from RPC "%s": result is None' % found_RPC.funcname})
+        elif sc.isstring(result):
+            from_file = True
+            dir_name, file_name = os.path.split(result)
+            output_name = file_name
+        elif isinstance(result,io.BytesIO):
+            from_file = False
+            bytesio = result
+            output_name = 'download.obj'
+        else:
+            try:
+                content = result[0]
+                output_name = result[1]
+                if sc.isstring(content):
+                    from_file = True
+                    dir_name, file_name = os.path.split(content)
+                elif isinstance(content,io.BytesIO):
+                    from_file = False
+                    bytesio = content
+                else:
+                    return robustjsonify({'error': 'Unrecognized RPC output'})
+            except Exception as E:
+                return robustjsonify({'error': 'Error reading RPC result (%s)' % E})
+
+        if from_file:
+            response = send_from_directory(dir_name, file_name, as_attachment=True)
+            response.status_code = 201  # Status 201 = Created
+            # We cannot remove the actual file at this point because it is in
+            # use during the actual download, so if it's a temp file, remove it
+            # once the response has been sent.
+            filepath = os.path.join(dir_name, file_name)
+            if self.datastore.tempspace.contains(filepath):
+                self.datastore.tempspace.release_on_close(response, filepath)
+        else:
+            response = send_file(bytesio, as_attachment=True, download_name=output_name)
+        response.headers['filename'] = output_name
+        if verbose: print(response)
+        return response # Return the response message.
 
 
     def show_config(self):
@@ -611,11 +1029,7 @@ class ScirisResource(Resource):
         self._wsgi = wsgi
 
     def render(self, request):
-        r = self._wsgi.render(request) # Get the WSGI render results (i.e. for Flask app).
-
-        # Keep the client browser from caching Flask response, and set the response as already being "expired."
-        request.responseHeaders.setRawHeaders(b'Cache-Control', [b'no-cache', b'no-store', b'must-revalidate'])
-        request.responseHeaders.setRawHeaders(b'expires', [b'0'])
+        r = self._wsgi.render(request) # Get the WSGI render results (i.e. for Flask app); caching headers are set by ScirisApp._cache_headers()
         
         # Pass back the WSGI render results.
         return r
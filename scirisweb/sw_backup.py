@@ -0,0 +1,204 @@
+"""
+sw_backup.py -- incremental backups and point-in-time restores of DataStores
+
+Each backup is a folder holding a manifest and the items changed since the previous
+backup, stored by content hash; a restore replays the last full backup and the
+increments after it, up to a chosen backup.
+"""
+
+import os
+import json
+import time
+import hashlib
+import itertools
+import sciris as sc
+from .sw_datastore import make_datastore, BaseDataStore
+from .sw_writebehind import WriteBehindDataStore
+
+backup_manifest = 'manifest.json' # Name of the file describing each backup made by backup_datastore()
+
+__all__ = ['backup_datastore', 'restore_datastore', 'list_backups']
+
+
+def list_backups(folder):
+    """
+    Return the manifests of the backups in a folder made by `backup_datastore()`, oldest first
+
+    Each manifest is a dict with the backup's 'id', 'kind' ('full' or 'incremental'),
+    'parent' (the id of the previous backup), 'created' (a timestamp), 'method' (how
+    changes were found), 'items' (key -> SHA-256 of its content), and 'deleted' (keys).
+    """
+    manifests = []
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name, backup_manifest)
+            if not name.startswith('.') and os.path.exists(path): # Backups still being written are in hidden folders
+                with open(path) as f:
+                    manifests.append(json.load(f))
+    return manifests
+
+
+def _backupchain(folder, until=None):
+    ''' The manifests needed to restore a backup: the last full backup up to it, then each increment '''
+    manifests = list_backups(folder)
+    if until is not None:
+        ids = [m['id'] for m in manifests]
+        if until not in ids:
+            errormsg = 'Backup "%s" not found in %s: available backups are %s' % (until, folder, ids)
+            raise sc.KeyNotFoundError(errormsg)
+        manifests = manifests[:ids.index(until)+1]
+    bases = [i for i,m in enumerate(manifests) if m['kind'] == 'full']
+    if not bases:
+        return []
+    return manifests[bases[-1]:]
+
+
+def _backupstate(chain):
+    ''' Replay a chain of backups into key -> (backup id, SHA-256) '''
+    state = {}
+    for manifest in chain:
+        for key,sha in manifest['items'].items():
+            state[key] = (manifest['id'], sha)
+        for key in manifest['deleted']:
+            state.pop(key, None)
+    return state
+
+
+def _changedsince(ds, version, batch):
+    ''' Keys changed after a version of the change feed, or None if the feed doesn't go back that far '''
+    if version is None or not ds._hasversion(version):
+        return None
+    keys = set()
+    since = version
+    while True: # Read on from the version, rather than from the start of the feed
+        changes = ds.changes(since=since, limit=batch)
+        if not changes:
+            break
+        keys.update(change['key'] for change in changes)
+        since = changes[-1]['version']
+    return keys
+
+
+def backup_datastore(src, folder, full=False, batch=None, verbose=True):
+    """
+    Make an incremental backup of a datastore, copying only what has changed since the
+    last backup in the folder (or everything, if it is the first or full=True).
+
+    Changed keys are found from the change feed, if the datastore has one and it goes
+    back to the previous backup; otherwise every item is read and compared by its hash,
+    which avoids copying unchanged items but still reads them all. Deleted keys are
+    recorded as tombstones. Each backup is a subfolder with a manifest (see
+    `list_backups()`) and the changed items, stored by the SHA-256 of their content.
+    As for `copy_datastore()`, keys starting with '_' are skipped.
+
+    :param src: Datastore, or URL, to back up
+    :param folder: Folder to keep the backups in
+    :param full: Whether to make a full backup even if there is a previous one
+    :param batch: Number of items to read from the datastore at a time (default 100)
+    :param verbose: Whether to print progress
+    :return: The manifest of the new backup
+
+    Example:
+        sw.backup_datastore('redis://127.0.0.1:6379/0', '/backups/myapp') # First time: full backup
+        sw.backup_datastore('redis://127.0.0.1:6379/0', '/backups/myapp') # Later: only the changes
+        sw.restore_datastore('/backups/myapp', 'redis://127.0.0.1:6379/1') # Restore the latest state
+    """
+    if batch is None: batch = 100
+    ds = src if isinstance(src, BaseDataStore) else make_datastore(src, verbose=False)
+    if isinstance(ds, WriteBehindDataStore):
+        ds.flush()
+    chain = [] if full else _backupchain(folder)
+    previous = _backupstate(chain)
+    now = time.time()
+    version = ds.lastversion() if ds.changefeed else None # Before reading anything, so changes made during the backup are included next time
+
+    # Work out which keys to check
+    changed = None
+    if chain and ds.changefeed:
+        changed = _changedsince(ds, chain[-1]['version'], batch)
+    if not chain:
+        method = 'full'
+    elif changed is not None:
+        method = 'changes'
+    else:
+        method = 'hashes'
+    if changed is None:
+        keys = ds.iterkeys(batch=batch)
+    else:
+        keys = iter(sorted(changed))
+
+    # Copy the items into a temporary folder, renamed into place when complete
+    backupid = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)) + '.%06iZ' % ((now % 1)*1e6)
+    tmpfolder = os.path.join(folder, '.' + backupid)
+    os.makedirs(os.path.join(tmpfolder, 'data'))
+    items = {}
+    seen = set()
+    while True:
+        chunk = list(itertools.islice(keys, batch))
+        if not chunk:
+            break
+        chunk = [key for key in chunk if not key.startswith('_')] # After checking for the end, since a whole batch may be skipped
+        if not chunk:
+            continue
+        for key,objstr in zip(chunk, ds._getmany(chunk)):
+            if objstr is None: # Deleted since it was listed or changed
+                continue
+            seen.add(key)
+            sha = hashlib.sha256(objstr).hexdigest()
+            if key in previous and previous[key][1] == sha:
+                continue
+            items[key] = sha
+            path = os.path.join(tmpfolder, 'data', sha)
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(objstr)
+
+    # Anything in the previous state that wasn't found is a deletion
+    candidates = previous.keys() if changed is None else [key for key in changed if key in previous]
+    deleted = sorted([key for key in candidates if key not in seen])
+
+    manifest = dict(id=backupid, kind='incremental' if chain else 'full', parent=chain[-1]['id'] if chain else None,
+                    created=now, source=repr(ds), method=method, version=version, items=items, deleted=deleted)
+    with open(os.path.join(tmpfolder, backup_manifest), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmpfolder, os.path.join(folder, backupid))
+    if verbose: print('DataStore: %s backup %s: %s items copied, %s deleted (changes found by %s)' % (manifest['kind'], backupid, len(items), len(deleted), method))
+    return manifest
+
+
+def restore_datastore(folder, dst, until=None, flush=True, batch=None, verbose=True):
+    """
+    Restore a datastore from the backups made by `backup_datastore()`: the last full
+    backup up to the chosen point, plus the increments after it.
+
+    :param folder: Folder containing the backups
+    :param dst: Datastore, or URL, to restore into
+    :param until: The id of the backup to restore to (default: the latest); see `list_backups()`
+    :param flush: Whether to remove everything else from the destination first
+    :param batch: Number of items to write at a time (default 100)
+    :param verbose: Whether to print progress
+    :return: The destination datastore
+    """
+    if batch is None: batch = 100
+    chain = _backupchain(folder, until=until)
+    if not chain:
+        errormsg = 'No full backup found in %s' % folder
+        raise FileNotFoundError(errormsg)
+    state = _backupstate(chain)
+    ds = dst if isinstance(dst, BaseDataStore) else make_datastore(dst, verbose=False)
+    if flush: # Delete rather than flushdb(), which would leave an SQL datastore without a table
+        existing = list(ds.iterkeys(batch=batch))
+        for i in range(0, len(existing), batch):
+            ds._deletemany(existing[i:i+batch])
+    keys = sorted(state.keys())
+    for i in range(0, len(keys), batch):
+        items = []
+        for key in keys[i:i+batch]:
+            backupid, sha = state[key]
+            with open(os.path.join(folder, backupid, 'data', sha), 'rb') as f:
+                items.append((key, f.read()))
+        ds._setmany(items)
+    if ds.accounting:
+        ds.recount()
+    if verbose: print('DataStore: restored %s items from backup %s' % (len(keys), chain[-1]['id']))
+    return ds
@@ -0,0 +1,110 @@
+"""
+sw_cli.py -- command-line maintenance tools for DataStores
+
+Usage:
+    python -m scirisweb.sw_cli compact sqlite:///storage.db
+    python -m scirisweb.sw_cli compact file:///srv/storage --throttle 0.1
+    python -m scirisweb.sw_cli compact sqlite:///shard0.db sqlite:///shard1.db --full
+    python -m scirisweb.sw_cli backup redis://127.0.0.1:6379/0 --to /backups/myapp --changefeed
+    python -m scirisweb.sw_cli backups /backups/myapp
+    python -m scirisweb.sw_cli restore /backups/myapp redis://127.0.0.1:6379/1 --until 20240101T000000.000000Z
+    python -m scirisweb.sw_cli analyze sqlite:///storage.db --sample 500 --output storage.json
+
+Each command prints its report as JSON. Commands that open a datastore take --changefeed
+and --accounting, which should match how the app opens it: e.g. backups only use the
+change feed to find what has changed if it is enabled.
+"""
+
+import json
+import argparse
+import sciris as sc
+from .sw_datastore import make_datastore
+from .sw_backup import backup_datastore, restore_datastore, list_backups
+
+
+def open_datastore(args):
+    ''' Open a datastore from one URL, or a sharded datastore from several, with the change feed and accounting if requested '''
+    urls = args.url
+    return make_datastore(urls[0] if len(urls) == 1 else urls, verbose=False, changefeed=args.changefeed or None, accounting=args.accounting or None)
+
+
+def compact(args):
+    ''' Reclaim space in a datastore; see DataStore.compact() '''
+    ds = open_datastore(args)
+    return ds.compact(throttle=args.throttle, full=args.full)
+
+
+def backup(args):
+    ''' Back up what has changed since the last backup; see backup_datastore() '''
+    ds = open_datastore(args)
+    manifest = backup_datastore(ds, args.to, full=args.full, verbose=False)
+    summary = {k:v for k,v in manifest.items() if k not in ['items', 'deleted']}
+    summary.update(items=len(manifest['items']), deleted=len(manifest['deleted']))
+    return summary
+
+
+def backups(args):
+    ''' List the backups in a folder '''
+    return [dict(id=m['id'], kind=m['kind'], parent=m['parent'], items=len(m['items']), deleted=len(m['deleted'])) for m in list_backups(args.folder)]
+
+
+def restore(args):
+    ''' Restore a datastore from a base backup and its increments; see restore_datastore() '''
+    ds = open_datastore(args)
+    restore_datastore(args.folder, ds, until=args.until, flush=not args.keep, verbose=False)
+    return dict(restored=args.until or list_backups(args.folder)[-1]['id'], keys=len(ds.keys()))
+
+
+def analyze(args):
+    ''' Report where the bytes are; see DataStore.analyze() '''
+    ds = open_datastore(args)
+    return ds.analyze(pattern=args.pattern, sample=args.sample, top=args.top, staleafter=args.staleafter, filename=args.output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m scirisweb.sw_cli', description='Maintenance tools for ScirisWeb datastores')
+    commands = parser.add_subparsers(dest='command', required=True)
+    store = argparse.ArgumentParser(add_help=False) # Options for opening the datastore
+    store.add_argument('--changefeed', action='store_true', help='open the datastore with its change feed enabled')
+    store.add_argument('--accounting', action='store_true', help='open the datastore with storage accounting enabled')
+
+    cmd = commands.add_parser('compact', parents=[store], help='reclaim space left by overwritten and deleted items; safe to run while the app is serving')
+    cmd.add_argument('url', nargs='+', help='datastore URL (several for a sharded datastore)')
+    cmd.add_argument('--throttle', type=float, default=None, help='seconds to pause between steps (default 0.01)')
+    cmd.add_argument('--full', action='store_true', help='also run steps that lock out writers, e.g. to enable incremental vacuuming on an old SQLite database')
+    cmd.set_defaults(func=compact)
+
+    cmd = commands.add_parser('backup', parents=[store], help='back up what has changed since the last backup (everything, the first time)')
+    cmd.add_argument('url', nargs='+', help='datastore URL (several for a sharded datastore)')
+    cmd.add_argument('--to', required=True, help='folder to keep the backups in')
+    cmd.add_argument('--full', action='store_true', help='make a full backup even if there is a previous one')
+    cmd.set_defaults(func=backup)
+
+    cmd = commands.add_parser('backups', help='list the backups in a folder')
+    cmd.add_argument('folder', help='folder containing the backups')
+    cmd.set_defaults(func=backups)
+
+    cmd = commands.add_parser('restore', parents=[store], help='restore a datastore from a full backup plus its increments')
+    cmd.add_argument('folder', help='folder containing the backups')
+    cmd.add_argument('url', nargs='+', help='datastore URL to restore into (several for a sharded datastore)')
+    cmd.add_argument('--until', default=None, help='id of the backup to restore to (default: the latest)')
+    cmd.add_argument('--keep', action='store_true', help="don't remove keys that aren't in the backup")
+    cmd.set_defaults(func=restore)
+
+    cmd = commands.add_parser('analyze', parents=[store], help='report sizes, largest keys, compression, and stale data, per objtype')
+    cmd.add_argument('url', nargs='+', help='datastore URL (several for a sharded datastore)')
+    cmd.add_argument('--pattern', default=None, help='only analyze keys matching this glob-style pattern')
+    cmd.add_argument('--sample', type=int, default=None, help='maximum number of items to decode (default 1000)')
+    cmd.add_argument('--top', type=int, default=None, help='number of largest and stalest keys to list (default 20)')
+    cmd.add_argument('--staleafter', type=float, default=None, help='days since last modified after which an item is stale (default 90)')
+    cmd.add_argument('--output', default=None, help='also write the report to this JSON file')
+    cmd.set_defaults(func=analyze)
+
+    args = parser.parse_args(argv)
+    output = args.func(args)
+    print(json.dumps(sc.sanitizejson(output), indent=2))
+    return output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+metrics.py -- lightweight in-process counters, gauges, and histograms
+
+These are used to instrument the DataStore (and other ScirisWeb components), and
+can be exported either as a dict or in the Prometheus text exposition format.
+"""
+
+import bisect
+import threading
+import sciris as sc
+
+__all__ = ['Metrics']
+
+
+# Default histogram buckets, in seconds -- from 50 µs to 10 s
+default_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(sc.prettyobj):
+    '''
+    A minimal, thread-safe metrics registry.
+
+    Metrics are identified by a name plus an optional set of labels (keyword
+    arguments). Counters only ever increase, gauges can be set to any value, and
+    histograms record observations into fixed buckets. All operations are
+    no-ops if enabled is False.
+
+    Args:
+        prefix  (str):  prefix for all metric names in the Prometheus output, e.g. 'scirisweb_datastore'
+        labels  (dict): constant labels to add to every metric in the Prometheus output
+        buckets (list): upper bounds for the histogram buckets
+        enabled (bool): whether to record anything
+
+    **Example**::
+
+        metrics = sw.Metrics(prefix='myapp')
+        metrics.inc('requests_total', op='get')
+        metrics.observe('latency_seconds', 0.002, op='get')
+        print(metrics.prometheus())
+    '''
+
+    def __init__(self, prefix=None, labels=None, buckets=None, enabled=True):
+        self.prefix  = prefix
+        self.labels  = dict(labels) if labels else {}
+        self.buckets = tuple(sorted(buckets)) if buckets else default_buckets
+        self.enabled = enabled
+        self.info    = {} # Metric name -> (kind, help string)
+        self.lock    = threading.Lock()
+        self.reset()
+        return
+
+
+    def reset(self):
+        ''' Clear all recorded values (but not the metric descriptions) '''
+        with self.lock:
+            self.counters   = {}
+            self.gauges     = {}
+            self.histograms = {}
+        return
+
+
+    def describe(self, name, kind, helpstr=''):
+        ''' Record the type ('counter', 'gauge', or 'histogram') and help string for a metric '''
+        self.info[name] = (kind, helpstr)
+        return
+
+
+    def inc(self, name, value=1, **labels):
+        ''' Increment a counter '''
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        return
+
+
+    def set(self, name, value, **labels):
+        ''' Set a gauge '''
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+        return
+
+
+    def observe(self, name, value, **labels):
+        ''' Record an observation in a histogram '''
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        ind = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0]*(len(self.buckets)+1), 0.0, 0] # Per-bucket counts (non-cumulative), sum, count
+            hist[0][ind] += 1
+            hist[1]      += value
+            hist[2]      += 1
+        return
+
+
+    def get(self, name, default=0, **labels):
+        ''' Get the current value of a counter or gauge, or the count of a histogram '''
+        key = (name, tuple(sorted(labels.items())))
+        if   key in self.counters:   return self.counters[key]
+        elif key in self.gauges:     return self.gauges[key]
+        elif key in self.histograms: return self.histograms[key][2]
+        else:                        return default
+
+
+    def todict(self):
+        ''' Return all metrics as a nested dict of name -> label string -> value '''
+        output = {}
+        with self.lock:
+            for store in [self.counters, self.gauges]:
+                for (name,labels),value in store.items():
+                    output.setdefault(name, {})[self._labelstr(labels)] = value
+            for (name,labels),(counts,total,count) in self.histograms.items():
+                output.setdefault(name, {})[self._labelstr(labels)] = {'count':count, 'sum':total, 'buckets':dict(zip(self._bucketstrs(), self._cumsum(counts)))}
+        return output
+
+
+    def prometheus(self):
+        ''' Render all metrics in the Prometheus text exposition format '''
+        prefix = self.prefix + '_' if self.prefix else ''
+        const = tuple(sorted(self.labels.items()))
+        lines = []
+        with self.lock:
+            entries = {}
+            for kind,store in [('counter', self.counters), ('gauge', self.gauges), ('histogram', self.histograms)]:
+                for (name,labels),value in store.items():
+                    entries.setdefault(name, (kind, []))[1].append((const+labels, value))
+        for name in sorted(entries.keys()):
+            kind,values = entries[name]
+            fullname = prefix + name
+            helpstr = self.info.get(name, (kind, ''))[1]
+            if helpstr: lines.append('# HELP %s %s' % (fullname, helpstr))
+            lines.append('# TYPE %s %s' % (fullname, kind))
+            for labels,value in sorted(values, key=lambda x: x[0]):
+                if kind == 'histogram':
+                    counts,total,count = value
+                    for le,cum in zip(self._bucketstrs(), self._cumsum(counts)):
+                        lines.append('%s_bucket%s %s' % (fullname, self._labelstr(labels+(('le',le),), braces=True), cum))
+                    lines.append('%s_sum%s %r' % (fullname, self._labelstr(labels, braces=True), total))
+                    lines.append('%s_count%s %s' % (fullname, self._labelstr(labels, braces=True), count))
+                else:
+                    lines.append('%s%s %r' % (fullname, self._labelstr(labels, braces=True), value))
+        return '\n'.join(lines) + '\n'
+
+
+    def _bucketstrs(self):
+        return ['%r' % b for b in self.buckets] + ['+Inf']
+
+
+    @staticmethod
+    def _cumsum(counts):
+        output = []
+        total = 0
+        for count in counts:
+            total += count
+            output.append(total)
+        return output
+
+
+    @staticmethod
+    def _labelstr(labels, braces=False):
+        ''' Convert a tuple of label pairs to a string, e.g. 'op="get"' '''
+        string = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k,v in labels)
+        if braces and string: string = '{%s}' % string
+        return string
@@ -11,15 +11,384 @@ Last update: 11/11/18 (gchadder3)
 
 # Imports
 
+import time
+import math
+import struct
+import pickle
+import hashlib
+import threading
+import itertools
+from collections import OrderedDict
 from functools import wraps
+import msgspec
 import sciris as sc
+from flask import current_app, has_request_context
+from flask_login import current_user
+from .sw_metrics import Metrics
 
-__all__ = ['ScirisRPC', 'RPCwrapper']
+__all__ = ['ScirisRPC', 'RPCCache', 'HTTPCache', 'RPCwrapper', 'cache_metrics']
+
+cache_separator = '::' # Separator in the datastore keys of cached results
+cache_header    = struct.Struct('<4sd') # Tag and expiry time at the start of each result cached in the datastore, so sweeps needn't decode them
+cache_tag       = b'SWRC'
+cache_sweep     = 60 # Minimum seconds between sweeps of expired results from the datastore, by each process
+cache_metrics = Metrics(prefix='scirisweb_rpc_cache') # Hits, misses, and evictions of all RPC caches, labeled by RPC name
+cache_metrics.describe('hits_total',      'counter', 'Calls answered from the cache')
+cache_metrics.describe('misses_total',    'counter', 'Calls that ran the RPC and cached its result')
+cache_metrics.describe('evictions_total', 'counter', 'Cached results dropped to stay under the maximum size')
+
+
+class RPCCache(sc.prettyobj):
+    '''
+    Cache of the results of an RPC that is a pure function of its arguments.
+
+    Results are kept in memory in each process (store='memory'), or in the app's
+    DataStore (store='datastore'), so that they are shared across workers. Each RPC
+    gets its own cache; use ``@RPC(cache=...)`` or ``app.register_RPC(cache=...)``
+    with True for the defaults, a number for the TTL, or a dict of these arguments.
+
+    Args:
+        name    (str):   the name of the RPC (set automatically)
+        ttl     (float): seconds a result is kept for (default: until invalidated or evicted)
+        maxsize (int):   maximum number of results kept in memory, least recently used evicted first (default 1000; not applied to the datastore)
+        scope   (str):   'global' to share results between users, or 'user' to cache them separately for each user
+        key     (str):   how to hash the arguments: 'json' (the default; arguments from the client are always JSON, and others are pickled), 'pickle', or a function of the RPC's arguments that returns a string
+        store   (str):   'memory' or 'datastore'
+
+    Results in the datastore are written directly to the backend, without accounting
+    or the change feed; expired ones are swept from time to time when results are
+    stored, or by calling `sweep()`.
+
+    **Example**::
+
+        @RPC(cache=dict(ttl=600, scope='user'))
+        def getoptions(category):
+            ...
+
+        getoptions.cache.invalidate() # E.g. after the options change
+    '''
+
+    def __init__(self, name=None, ttl=None, maxsize=None, scope=None, key=None, store=None, datastore=None):
+        if maxsize is None: maxsize = 1000
+        if scope   is None: scope   = 'global'
+        if key     is None: key     = 'json'
+        if store   is None: store   = 'memory'
+        if scope not in ['global', 'user']:
+            errormsg = 'RPC cache scope must be "global" or "user", not "%s"' % scope
+            raise ValueError(errormsg)
+        if store not in ['memory', 'datastore']:
+            errormsg = 'RPC cache store must be "memory" or "datastore", not "%s"' % store
+            raise ValueError(errormsg)
+        if not (callable(key) or key in ['json', 'pickle']):
+            errormsg = 'RPC cache key must be "json", "pickle", or a function, not "%s"' % key
+            raise ValueError(errormsg)
+        self.name      = name
+        self.ttl       = ttl
+        self.maxsize   = maxsize
+        self.scope     = scope
+        self.key       = key
+        self.store     = store
+        self.datastore = datastore # If None, the DataStore of the current Flask app
+        self.entries   = OrderedDict() # For store='memory': (username, hash) -> (expiry time, result), least recently used first
+        self.lock      = threading.Lock()
+        self.nextsweep = None # For store='datastore' with a TTL: when to next sweep expired results
+        return
+
+
+    @classmethod
+    def fromspec(cls, spec, name=None):
+        ''' Make a cache from the cache argument of an RPC: None/False, True, a TTL, a dict of arguments, or an RPCCache '''
+        if spec is None or spec is False:
+            return None
+        elif isinstance(spec, RPCCache):
+            if spec.name is None: spec.name = name
+            return spec
+        elif spec is True:
+            return cls(name=name)
+        elif isinstance(spec, dict):
+            return cls(name=name, **spec)
+        else:
+            return cls(name=name, ttl=float(spec))
+
+
+    def username(self):
+        ''' The current user for per-user caching, or '' for global caching or outside a request '''
+        if self.scope == 'global' or not has_request_context():
+            return ''
+        try:
+            return current_user.username if current_user.is_authenticated else '_anonymous'
+        except Exception: # E.g. users are not enabled
+            return '_anonymous'
+
+
+    def hash(self, args, kwargs):
+        ''' Hash the arguments of a call into a cache key '''
+        data = None
+        if callable(self.key):
+            data = str(self.key(*args, **kwargs)).encode()
+        elif self.key == 'json':
+            try:
+                data = msgspec.json.encode([list(args), sorted(kwargs.items())])
+            except (TypeError, msgspec.EncodeError): # E.g. a NumPy array, if the RPC is called from Python
+                pass
+        if data is None:
+            data = pickle.dumps((tuple(args), sorted(kwargs.items())), protocol=4)
+        return hashlib.sha256(data).hexdigest()
+
+
+    def _getdatastore(self):
+        return self.datastore if self.datastore is not None else current_app.datastore
+
+
+    def _dskey(self, username, digest=None):
+        ''' The datastore key for a result, or the prefix of the keys for a user if digest is None '''
+        parts = ['rpccache', self.name, hashlib.sha256(username.encode()).hexdigest()[:16]]
+        if digest is not None: parts.append(digest)
+        return cache_separator.join(parts)
+
+
+    def get(self, args, kwargs):
+        '''
+        Look up the result of a call.
+
+        :return: (found, result, key), where key is passed to `set()` if it wasn't found
+        '''
+        key = (self.username(), self.hash(args, kwargs))
+        now = time.time()
+        if self.store == 'memory':
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    if entry[0] is None or entry[0] > now:
+                        self.entries.move_to_end(key)
+                    else:
+                        del self.entries[key]
+                        entry = None
+        else:
+            ds = self._getdatastore()
+            objstr = ds._get(self._dskey(*key))
+            entry = None
+            if objstr is not None:
+                expiry = self._expiry(objstr)
+                if expiry > now: # Otherwise it's expired, and will be overwritten by set()
+                    entry = (expiry, ds._decode(bytes(objstr[cache_header.size:])))
+        if entry is None:
+            cache_metrics.inc('misses_total', rpc=self.name)
+            return False, None, key
+        cache_metrics.inc('hits_total', rpc=self.name)
+        return True, entry[1], key
+
+
+    def set(self, key, result):
+        ''' Store the result of a call, using the key from `get()` '''
+        entry = (time.time() + self.ttl if self.ttl is not None else None, result)
+        if self.store == 'memory':
+            evicted = 0
+            with self.lock:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                    evicted += 1
+            if evicted: cache_metrics.inc('evictions_total', evicted, rpc=self.name)
+        else:
+            ds = self._getdatastore()
+            expiry = entry[0] if entry[0] is not None else math.inf
+            ds._set(self._dskey(*key), cache_header.pack(cache_tag, expiry) + ds._encode(result))
+            if self.ttl is not None: # Otherwise results never expire
+                now = time.time()
+                with self.lock:
+                    sweep = self.nextsweep is not None and self.nextsweep <= now
+                    if sweep or self.nextsweep is None:
+                        self.nextsweep = now + max(self.ttl, cache_sweep)
+                if sweep:
+                    self.sweep()
+        return
+
+
+    @staticmethod
+    def _expiry(objstr):
+        ''' The expiry time of a result cached in the datastore, or 0 if it was stored by an older version '''
+        if len(objstr) < cache_header.size: return 0
+        tag, expiry = cache_header.unpack_from(objstr)
+        return expiry if tag == cache_tag else 0
+
+
+    def sweep(self, batch=None):
+        '''
+        Remove expired results from the datastore (results in memory are removed when
+        they're looked up, or evicted); returns the number removed.
+
+        :param batch: Number of results to check at a time (default 1000)
+        '''
+        if self.store != 'datastore':
+            return 0
+        if batch is None: batch = 1000
+        ds = self._getdatastore()
+        now = time.time()
+        count = 0
+        keys = ds.iterkeys(cache_separator.join(['rpccache', self.name, '*']), batch=batch)
+        while True:
+            chunk = list(itertools.islice(keys, batch))
+            if not chunk: break
+            expired = [k for k,objstr in zip(chunk, ds._getmany(chunk)) if objstr is not None and self._expiry(objstr) <= now]
+            ds._deletemany(expired)
+            count += len(expired)
+        if count: cache_metrics.inc('evictions_total', count, rpc=self.name)
+        return count
+
+
+    def invalidate(self, args=None, kwargs=None, username=None, allusers=None):
+        '''
+        Remove cached results: for one call, if args or kwargs are given, or else all of them.
+
+        :param args: the positional arguments of the call to forget
+        :param kwargs: the keyword arguments of the call to forget
+        :param username: for per-user caches, the user whose results to remove (default: the current user)
+        :param allusers: for per-user caches, remove the results for every user (default: True when removing all results)
+        :return: the number of results removed (for one call in the datastore, the number of users it was removed for, whether or not it was cached)
+        '''
+        single = args is not None or kwargs is not None
+        if allusers is None: allusers = not single and username is None
+        if self.scope == 'global':   usernames = ['']
+        elif allusers:               usernames = None # All of them
+        elif username is not None:   usernames = [username]
+        else:                        usernames = [self.username()]
+        digest = self.hash(args or [], kwargs or {}) if single else None
+
+        if self.store == 'memory':
+            with self.lock:
+                keys = [k for k in self.entries if (usernames is None or k[0] in usernames) and (digest is None or k[1] == digest)]
+                for k in keys:
+                    del self.entries[k]
+            return len(keys)
+        else:
+            ds = self._getdatastore()
+            if usernames is None:
+                return ds.delete_pattern(cache_separator.join(['rpccache', self.name, '*']))
+            if digest is not None:
+                ds._deletemany([self._dskey(user, digest) for user in usernames])
+                return len(usernames)
+            return sum([ds.delete_pattern(self._dskey(user) + cache_separator + '*') for user in usernames])
+
+
+    def clear(self):
+        ''' Remove all cached results '''
+        return self.invalidate(allusers=True)
+
+
+    def stats(self):
+        ''' The number of hits, misses, and evictions, the hit rate, and (for the memory store) the number of cached results '''
+        hits   = cache_metrics.get('hits_total', rpc=self.name)
+        misses = cache_metrics.get('misses_total', rpc=self.name)
+        output = dict(hits=hits, misses=misses, evictions=cache_metrics.get('evictions_total', rpc=self.name))
+        output['hitrate'] = hits/(hits+misses) if hits+misses else None
+        if self.store == 'memory':
+            output['size'] = len(self.entries)
+        return output
+
+
+class HTTPCache(sc.prettyobj):
+    '''
+    Policy for caching the responses of an RPC in the browser.
+
+    By default, RPC responses are sent with ``Cache-Control: no-cache, no-store,
+    must-revalidate``, so every call downloads the result again. An RPC with an HTTP
+    cache policy instead gets an ETag, and a client that sends the ETag back in
+    ``If-None-Match`` gets an empty 304 (Not Modified) response if it still matches.
+    The ETag is either a hash of the response body, or -- if ``etag`` is a function --
+    a hash of the version it returns for the call's arguments, in which case the RPC
+    isn't run at all if the client's copy is current. With ``max_age``, the client may
+    reuse its copy for that many seconds without asking. RPCs with a policy can also be
+    called with GET (``/rpcs?funcname=...&args=[...]&kwargs={...}``), so that the
+    browser does all of this itself. Use ``@RPC(httpcache=...)`` or
+    ``app.register_RPC(httpcache=...)`` with True for the defaults, a number for the
+    max-age, or a dict of these arguments.
+
+    Args:
+        max_age   (int):  seconds the client may reuse a response without checking its ETag (default: check every time)
+        etag      (bool/func): True to hash the response body (the default), a function of the RPC's arguments that returns the version of its result (None to hash the body), or False for no ETag
+        public    (bool): whether shared caches (e.g. proxies) may keep the response (default False; set only if the result is the same for every user)
+        immutable (bool): whether the result for given arguments never changes, so the client need never revalidate it while it is fresh
+
+    **Example**::
+
+        @RPC(httpcache=dict(etag=lambda project_id: datastore.get(project_id).modified))
+        def getproject(project_id):
+            ...
+
+        @RPC(httpcache=dict(max_age=86400, immutable=True))
+        def getresult(result_id):
+            ...
+    '''
+
+    def __init__(self, max_age=None, etag=True, public=False, immutable=False):
+        if not (etag in [True, False] or callable(etag)):
+            errormsg = 'HTTP cache etag must be True, False, or a function, not "%s"' % etag
+            raise ValueError(errormsg)
+        if immutable and not max_age:
+            errormsg = 'An immutable HTTP cache policy needs a max_age'
+            raise ValueError(errormsg)
+        self.max_age   = int(max_age) if max_age else None
+        self.etag      = etag
+        self.public    = public
+        self.immutable = immutable
+        return
+
+
+    @classmethod
+    def fromspec(cls, spec):
+        ''' Make a policy from the httpcache argument of an RPC: None/False, True, a max-age, a dict of arguments, or an HTTPCache '''
+        if spec is None or spec is False:
+            return None
+        elif isinstance(spec, HTTPCache):
+            return spec
+        elif spec is True:
+            return cls()
+        elif isinstance(spec, dict):
+            return cls(**spec)
+        else:
+            return cls(max_age=spec)
+
+
+    def version(self, funcname, args, kwargs):
+        ''' The ETag of a call from the version of its result, or None if there is no version function or it returns None '''
+        if not callable(self.etag):
+            return None
+        version = self.etag(*args, **kwargs)
+        if version is None:
+            return None
+        data = msgspec.json.encode([funcname, list(args), sorted(kwargs.items()), str(version)])
+        return hashlib.sha256(data).hexdigest()[:32]
+
+
+    def apply(self, response, etag=None):
+        ''' Set the Cache-Control header and the ETag (hashing the body if no etag is given) of a response '''
+        cc = response.cache_control
+        if self.public: cc.public  = True
+        else:           cc.private = True
+        if self.max_age:
+            cc.max_age = self.max_age
+            if self.immutable: cc.immutable = True
+        else:
+            cc.no_cache = True # Keep it, but check the ETag before each use
+        if self.etag is not False:
+            if etag is None and response.status_code == 200:
+                etag = hashlib.sha256(response.get_data()).hexdigest()[:32]
+            if etag is not None:
+                response.set_etag(etag)
+        return response
 
 
 
 class ScirisRPC(sc.prettyobj):
     '''
+    Call type:
+        'normal':   the result is sent back as JSON (or a binary format, if requested)
+        'upload':   the uploaded file is saved, and its path passed as the first argument
+        'download': the result is a filename or BytesIO (optionally with a download name), which is sent as a file
+        'stream':   the result is an iterable, usually a generator, whose items are sent as they are produced, as NDJSON
+
     Validation type:
         'none' : no validation required
         'any':   any login validates
@@ -27,13 +396,29 @@ class ScirisRPC(sc.prettyobj):
         'admin': any admin login validates
         'user <name>': being logged in as <name> validates (TODO)
         'disabled': presently disabled for clients
+
+    Cache:
+        None: results are not cached (default)
+        True, a TTL in seconds, or a dict of arguments to RPCCache: results are cached, see RPCCache
+
+    HTTP cache:
+        None: responses are sent with no-cache headers (default)
+        True, a max-age in seconds, or a dict of arguments to HTTPCache: responses get an ETag and can be reused by the client, see HTTPCache
     '''
-    def __init__(self, call_func, call_type='normal', override=False, validation='none'):
+    def __init__(self, call_func, call_type='normal', override=False, validation='none', cache=None, httpcache=None):
         self.call_func  = call_func
         self.funcname   = call_func.__name__
         self.call_type  = call_type
         self.override   = override
         self.validation = validation
+        self.cache      = RPCCache.fromspec(cache, name=self.funcname) # Cache of results; see RPCCache
+        if self.cache is not None and call_type != 'normal':
+            errormsg = 'Only normal RPCs can be cached, not "%s" RPCs like %s()' % (call_type, self.funcname)
+            raise ValueError(errormsg)
+        self.httpcache  = HTTPCache.fromspec(httpcache) # Browser caching of responses; see HTTPCache
+        if self.httpcache is not None and call_type != 'normal':
+            errormsg = 'Only normal RPCs can have an HTTP cache policy, not "%s" RPCs like %s()' % (call_type, self.funcname)
+            raise ValueError(errormsg)
             
 
         
@@ -44,7 +429,9 @@ def RPCwrapper(RPC_dict=None, **callerkwargs):
             def wrapper(*args, **kwargs):        
                 output = RPC_func(*args, **kwargs)
                 return output
-            RPC_dict[RPC_func.__name__] = ScirisRPC(RPC_func, **callerkwargs) # Create the RPC and add it to the dictionary.
+            new_RPC = ScirisRPC(RPC_func, **callerkwargs) # Create the RPC and add it to the dictionary.
+            RPC_dict[RPC_func.__name__] = new_RPC
+            wrapper.cache = new_RPC.cache # So the RPC's module can invalidate the cache
             return wrapper
         return RPC_decorator
     return RPC_decorator_factory
\ No newline at end of file
@@ -0,0 +1,404 @@
+"""
+sw_sharding.py -- spreading keys over several DataStores
+
+ShardedDataStore maps each key to one of several backends (of any type) with a
+consistent hash ring, so that adding a shard only moves about 1/n of the keys;
+`sw.make_datastore()` creates one when given a list of URLs.
+"""
+
+import time
+import bisect
+import hashlib
+import itertools
+import threading
+import sciris as sc
+from .sw_datastore import make_datastore, BaseDataStore
+
+__all__ = ['ShardedDataStore']
+
+
+class HashRing(sc.prettyobj):
+    '''
+    Consistent hash ring used by ShardedDataStore to map keys to shards. Each node
+    is placed on the ring at several points ("virtual nodes") so that keys are spread
+    evenly, and adding a node only moves the keys that now belong to it.
+    '''
+
+    def __init__(self, nodes=None, vnodes=None):
+        if vnodes is None: vnodes = 64
+        self.vnodes = vnodes
+        self.nodes  = []
+        self.points = [] # Sorted hashes of the virtual nodes
+        self.owners = [] # Node for each point
+        for node in sc.tolist(nodes):
+            self.add(node)
+        return
+
+    @staticmethod
+    def hash(string):
+        return int.from_bytes(hashlib.md5(string.encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        ''' Add a node to the ring; don't use this on a ring that other threads are looking keys up in, but add to a copy '''
+        if node in self.nodes:
+            errormsg = 'Node "%s" is already in the hash ring' % node
+            raise ValueError(errormsg)
+        points = list(self.points)
+        owners = list(self.owners)
+        for v in range(self.vnodes):
+            point = self.hash('%s#%s' % (node, v))
+            ind = bisect.bisect(points, point)
+            points.insert(ind, point)
+            owners.insert(ind, node)
+        self.nodes  = self.nodes + [node]
+        self.points = points
+        self.owners = owners
+        return
+
+    def lookup(self, key):
+        ''' Return the node that a key belongs to '''
+        ind = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[ind]
+
+    def copy(self):
+        return sc.dcp(self)
+
+
+class ShardedDataStore(BaseDataStore):
+    """
+    DataStore that spreads keys over several backend datastores using consistent hashing.
+
+    Each shard can be any URL accepted by `make_datastore()`, so backends can be mixed,
+    e.g. several Redis instances in production, or several SQLite files for testing.
+    Operations on single keys go to the shard that owns the key; `keys()`, `iterkeys()`,
+    `getmany()` etc. fan out to all shards (or to the relevant shards) and merge the results.
+
+    Shards can be added with `add_shard()`. Only the keys that belong to the new shard
+    are moved, and they can be moved incrementally with `rebalance()`: until rebalancing
+    is complete, reads fall back to a key's previous shard.
+
+    :param urls: List of backend URLs
+    :param vnodes: Number of points each shard gets on the hash ring
+    :param shardargs: Extra keyword arguments passed to `make_datastore()` for each shard
+
+    Example:
+        ds = sw.make_datastore(['redis://127.0.0.1:6379/0', 'redis://127.0.0.1:6380/0'])
+        ds.add_shard('redis://127.0.0.1:6381/0')
+    """
+
+    def __init__(self, urls, vnodes=None, shardargs=None, *args, **kwargs):
+        if not urls:
+            errormsg = 'To create a ShardedDataStore, you must supply at least one URL'
+            raise ValueError(errormsg)
+        self.shardargs = shardargs if shardargs else {}
+        self.shards    = sc.odict()
+        self.migration = None # Generator of keys that still need to be moved
+        self.lock      = threading.RLock()
+        ring = HashRing(vnodes=vnodes)
+        for url in urls:
+            self.shards[url] = make_datastore(url, verbose=False, **self.shardargs)
+            ring.add(url)
+        self.rings = (ring, None) # The hash ring, and the one prior to adding a shard (only while rebalancing); replaced together, never modified
+        self.url = list(self.shards.keys())
+
+        # Finish construction
+        super().__init__(*args, **kwargs)
+        return
+
+
+    def __repr__(self):
+        return '<ShardedDataStore over %s shards (%s) with temp folder %s>' % (len(self.shards), ', '.join(self.shards.keys()), self.tempfolder)
+
+
+    ### ROUTING
+
+    @property
+    def ring(self):
+        ''' The hash ring that keys are routed by '''
+        return self.rings[0]
+
+
+    @property
+    def oldring(self):
+        ''' The hash ring prior to adding a shard, while rebalancing; else None '''
+        return self.rings[1]
+
+
+    def _shard(self, key, rings=None):
+        ''' The datastore that a key belongs to '''
+        if rings is None: rings = self.rings
+        return self.shards[rings[0].lookup(key)]
+
+
+    def _oldshard(self, key, rings=None):
+        ''' The datastore that a key belonged to before the current rebalancing, if different '''
+        if rings is None: rings = self.rings
+        ring, oldring = rings
+        if oldring is None: return None
+        shard = self.shards[oldring.lookup(key)]
+        return shard if shard is not self.shards[ring.lookup(key)] else None
+
+
+    def _groupby(self, keys, rings=None):
+        ''' Group a list of keys by shard, returning a dict of shard URL -> list of indices '''
+        if rings is None: rings = self.rings
+        ring = rings[0]
+        groups = {}
+        for i,key in enumerate(keys):
+            groups.setdefault(ring.lookup(key), []).append(i)
+        return groups
+
+
+    def _owns(self, url, key, rings=None):
+        ''' Whether a key found on shard url should be listed from that shard; avoids duplicates '''
+        if rings is None: rings = self.rings
+        ring, oldring = rings
+        if ring.lookup(key) == url:
+            return True
+        elif oldring is not None and oldring.lookup(key) == url:
+            return not self.shards[ring.lookup(key)].exists(key) # Not yet moved
+        else:
+            return False # E.g. each shard's own settings key
+
+
+    ### DEFINE MANDATORY FUNCTIONS
+
+    def _set(self, key, objstr):
+        rings = self.rings # One snapshot, so the shard and whether we're rebalancing agree
+        if rings[1] is None: # Not rebalancing, so no need to lock
+            return self._shard(key, rings)._set(key, objstr)
+        with self.lock:
+            rings = self.rings
+            self._shard(key, rings)._set(key, objstr)
+            oldshard = self._oldshard(key, rings)
+            if oldshard is not None:
+                oldshard._delete(key) # So the stale copy can't be moved over the new one
+        return
+
+
+    def _get(self, key):
+        rings = self.rings
+        shard = self._shard(key, rings)
+        objstr = shard._get(key)
+        if objstr is None:
+            oldshard = self._oldshard(key, rings)
+            if oldshard is not None:
+                objstr = oldshard._get(key)
+                if objstr is None: # It may have been moved between the two reads: rebalance() writes the new copy before deleting the old one
+                    objstr = shard._get(key)
+        return objstr
+
+
+    def _delete(self, key):
+        rings = self.rings
+        if rings[1] is None:
+            return self._shard(key, rings)._delete(key)
+        with self.lock:
+            rings = self.rings
+            self._shard(key, rings)._delete(key)
+            oldshard = self._oldshard(key, rings)
+            if oldshard is not None:
+                oldshard._delete(key)
+        return
+
+
+    def _flushdb(self):
+        for shard in self.shards.values():
+            shard._flushdb()
+        return
+
+
+    def _keys(self):
+        return self.keys()
+
+
+    ### FAN OUT MULTI-KEY OPERATIONS
+
+    def keys(self, pattern=None):
+        t0 = time.perf_counter()
+        rings = self.rings
+        keys = []
+        for url,shard in self.shards.items():
+            keys += [key for key in shard.keys(pattern=pattern) if self._owns(url, key, rings)]
+        self._record('keys', time.perf_counter()-t0)
+        return keys
+
+
+    def iterkeys(self, pattern=None, batch=None):
+        for url,shard in self.shards.items():
+            for key in shard.iterkeys(pattern=pattern, batch=batch):
+                if self._owns(url, key):
+                    yield key
+
+
+    def exists(self, key):
+        rings = self.rings
+        shard = self._shard(key, rings)
+        if shard.exists(key):
+            return True
+        oldshard = self._oldshard(key, rings)
+        return oldshard is not None and (oldshard.exists(key) or shard.exists(key)) # As for _get()
+
+
+    def _getmany(self, keys):
+        rings = self.rings
+        output = [None]*len(keys)
+        for url,inds in self._groupby(keys, rings).items():
+            objstrs = self.shards[url]._getmany([keys[i] for i in inds])
+            for i,objstr in zip(inds, objstrs):
+                output[i] = objstr
+        if rings[1] is not None: # Fall back to the previous shard for anything not yet moved
+            for i,key in enumerate(keys):
+                if output[i] is None:
+                    oldshard = self._oldshard(key, rings)
+                    if oldshard is not None:
+                        output[i] = oldshard._get(key)
+                        if output[i] is None: # As for _get()
+                            output[i] = self._shard(key, rings)._get(key)
+        return output
+
+
+    def _setmany(self, items):
+        with self.lock:
+            for url,inds in self._groupby([key for key,objstr in items]).items():
+                self.shards[url]._setmany([items[i] for i in inds])
+            if self.oldring is not None:
+                for key,objstr in items:
+                    oldshard = self._oldshard(key)
+                    if oldshard is not None:
+                        oldshard._delete(key)
+        return
+
+
+    def _deletemany(self, keys):
+        with self.lock:
+            for url,inds in self._groupby(keys).items():
+                self.shards[url]._deletemany([keys[i] for i in inds])
+            if self.oldring is not None:
+                for key in keys:
+                    oldshard = self._oldshard(key)
+                    if oldshard is not None:
+                        oldshard._delete(key)
+        return
+
+
+    def _deletepattern(self, pattern, batch, ondelete=None):
+        return sum([shard._deletepattern(pattern, batch, ondelete) for shard in self.shards.values()])
+
+
+    ### ADDING SHARDS
+
+    def add_shard(self, url, rebalance=True, batch=None):
+        '''
+        Add a new shard. By default, keys that now belong to the new shard are moved
+        immediately; with rebalance=False, call `rebalance()` (e.g. periodically with
+        maxkeys set) to move them incrementally.
+        '''
+        with self.lock:
+            if self.migration is not None:
+                errormsg = 'Cannot add shard "%s": the previous rebalancing is not complete' % url
+                raise RuntimeError(errormsg)
+            shard = make_datastore(url, verbose=False, **self.shardargs)
+            ring = self.ring.copy()
+            ring.add(url)
+            self.shards[url] = shard # Before the new ring, so that lookups never find a shard that isn't there yet
+            self.rings = (ring, self.ring) # Both rings in one assignment, so readers never see one without the other
+            self.url = list(self.shards.keys())
+            self.migration = self._misplaced(batch=batch)
+        if self.verbose: print('DataStore: added shard %s' % url)
+        if rebalance:
+            self.rebalance(batch=batch)
+        return shard
+
+
+    def _misplaced(self, batch=None):
+        ''' Generator of (old shard, key) for keys that need to move '''
+        ring, oldring = self.rings
+        for url,shard in list(self.shards.items()):
+            for key in shard.iterkeys(batch=batch):
+                if oldring.lookup(key) == url and ring.lookup(key) != url:
+                    yield shard, key
+
+
+    def rebalance(self, maxkeys=None, batch=None):
+        '''
+        Move keys to their new shards after add_shard(). Moves at most maxkeys keys (all
+        if None), in batches of batch keys, and returns the number moved. Rebalancing
+        is complete when rebalancing() returns False.
+        '''
+        if batch is None: batch = 100
+        if self.migration is None: return 0
+        moved = 0
+        done = False
+        while not done and (maxkeys is None or moved < maxkeys):
+            n = batch if maxkeys is None else min(batch, maxkeys-moved)
+            chunk = list(itertools.islice(self.migration, n))
+            if len(chunk) < n: done = True
+            with self.lock:
+                for oldshard,key in chunk:
+                    newshard = self._shard(key)
+                    if not newshard.exists(key): # Otherwise, it's been written since rebalancing started
+                        objstr = oldshard._get(key)
+                        if objstr is not None:
+                            newshard._set(key, objstr)
+                    oldshard._delete(key)
+            moved += len(chunk)
+        if done:
+            with self.lock:
+                self.migration = None
+                self.rings = (self.ring, None)
+        if self.verbose: print('DataStore: moved %s keys%s' % (moved, ' (rebalancing complete)' if done else ''))
+        return moved
+
+
+    def rebalancing(self):
+        ''' Whether keys are still being moved after adding a shard '''
+        return self.migration is not None
+
+
+    ### MAINTENANCE
+
+    def _compact(self, throttle, full):
+        reports = {url:shard._compact(throttle, full) for url,shard in self.shards.items()}
+        report = dict(shards=reports)
+        for which in ['before', 'after']:
+            sizes = [r.get(which) for r in reports.values()]
+            report[which] = None if None in sizes else sum(sizes)
+        return report
+
+
+    ### ACCOUNTING AND CHANGE FEED, STORED ON THE FIRST SHARD
+
+    def _makeaccountant(self):
+        shard = self.shards[0]
+        if shard.accountant is None:
+            shard.accountant = shard._makeaccountant()
+        return shard.accountant
+
+
+    def _initchangefeed(self):
+        shard = self.shards[0]
+        self.feedcond = shard.feedcond
+        shard.feedlength = self.feedlength
+        shard._initchangefeed()
+        return
+
+
+    def _appendchanges(self, changes):
+        return self.shards[0]._appendchanges(changes)
+
+
+    def _lastversion(self):
+        return self.shards[0]._lastversion()
+
+
+    def _hasversion(self, version):
+        return self.shards[0]._hasversion(version)
+
+
+    def _fetchchanges(self, since, limit):
+        return self.shards[0]._fetchchanges(since, limit)
+
+
+    def _readchanges(self, since, limit, timeout):
+        return self.shards[0]._readchanges(since, limit, timeout)
@@ -4,8 +4,10 @@ tasks.py -- code related to Sciris task queue management
 Last update: 2018sep23
 """
 
+import datetime
 import traceback
 from functools import wraps
+from typing import Any
 from celery import Celery
 from time import sleep
 import sciris as sc
@@ -53,7 +55,17 @@ class Task(sc.prettyobj):
         stop_time (datetime)  -- the time the task completed
         pending_time (int)    -- the time the process has been waiting to be executed on the server in seconds        
         execution_time (int)  -- the time the process required to complete
+
+    Like users, tasks are stored as compact records (see `User` and `sw_datastore.dumprecord()`),
+    unless they have arguments or attributes that the record schema can't hold.
     '''
+
+    __slots__ = ('task_id', 'uid', 'status', 'error_msg', 'error_text', 'func_name', 'args', 'kwargs', 'result_id',
+                 'queue_time', 'start_time', 'stop_time', 'pending_time', 'execution_time')
+    _schemaversion = 1
+    _schema = (('task_id', Any), ('uid', Any), ('status', str), ('error_msg', Any), ('error_text', Any), ('func_name', Any), ('args', Any),
+               ('kwargs', Any), ('result_id', Any), ('queue_time', datetime.datetime), ('start_time', datetime.datetime),
+               ('stop_time', datetime.datetime), ('pending_time', Any), ('execution_time', Any))
     
     def  __init__(self, task_id):
         self.task_id        = task_id # Set the task ID (what the client typically knows as the task).
@@ -112,12 +124,21 @@ Function kwargs: {self.kwargs}
                   }
         return output
 
+    def __getstate__(self):
+        ''' Pickle the attributes as a dict, as for tasks saved before __slots__ were added '''
+        state = dict(self.__dict__)
+        for attr in self.__slots__:
+            if hasattr(self, attr):
+                state[attr] = getattr(self, attr)
+        return state
+
     def __setstate__(self, state):
 
         ### Migration for changing errorText to errorMsg+errorText
         if 'error_msg' not in state:
             state['error_msg'] = 'Error occured - please check console'
-        self.__dict__ = state
+        for attr,value in state.items():
+            setattr(self, attr, value)
 
 
 ################################################################################
@@ -134,9 +155,15 @@ def get_datastore(config=None):
         datastore = sw.flaskapp.datastore
         assert datastore is not None
     except:
-        if isinstance(config, dict): datastore_url = config['DATASTORE_URL']
-        else:                        datastore_url = config.DATASTORE_URL
-        datastore = ds.make_datastore(url=datastore_url)
+        if isinstance(config, dict):
+            datastore_url = config['DATASTORE_URL']
+            writebehind   = config.get('DATASTORE_WRITEBEHIND')
+            datastoreargs = config.get('DATASTORE_ARGS')
+        else:
+            datastore_url = config.DATASTORE_URL
+            writebehind   = getattr(config, 'DATASTORE_WRITEBEHIND', None)
+            datastoreargs = getattr(config, 'DATASTORE_ARGS', None)
+        datastore = ds.make_datastore(url=datastore_url, writebehind=writebehind, **(datastoreargs or {}))
     return datastore
 
 
@@ -0,0 +1,298 @@
+"""
+tempspace.py -- managed temporary space for uploaded and downloaded files
+
+Each DataStore (and DataDir) has a TempSpace wrapping its temporary folder. Files are
+kept in per-user subfolders, and can be limited by total and per-user size quotas and
+by age, with the least recently used files evicted first. Files being uploaded or
+downloaded are pinned so that they are not evicted while in use.
+"""
+
+import os
+import time
+import threading
+import sciris as sc
+from flask import has_request_context
+from flask_login import current_user
+from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
+
+__all__ = ['QuotaExceededError', 'TempSpace']
+
+
+class QuotaExceededError(Exception):
+    ''' Raised when storing something would exceed a size quota '''
+    pass
+
+
+class TempSpace(sc.prettyobj):
+    '''
+    Managed temporary space, with quotas and sweeping.
+
+    Files for the current user are stored in <folder>/users/<username>/ (see `path()`);
+    files outside the users folder are shared. Quotas and the maximum age are all
+    optional; if none are set, nothing is ever evicted.
+
+    Args:
+        folder    (str):   the folder to manage, e.g. the datastore's tempfolder
+        quota     (int):   maximum total size in bytes
+        userquota (int):   maximum size in bytes for each user's subfolder
+        maxage    (float): maximum time in seconds since a file was last used
+        interval  (float): if set, sweep in a background thread every interval seconds
+        verbose   (bool):  whether to print out evictions
+
+    **Example**::
+
+        tempspace = sw.TempSpace('/tmp/myapp', quota=10e9, userquota=1e9, maxage=24*3600, interval=600)
+        path = tempspace.path('results.xlsx') # Inside an RPC: a path in the current user's folder
+    '''
+
+    def __init__(self, folder, quota=None, userquota=None, maxage=None, interval=None, verbose=False):
+        self.folder    = folder
+        self.quota     = quota
+        self.userquota = userquota
+        self.maxage    = maxage
+        self.interval  = interval
+        self.verbose   = verbose
+        self.pinned    = {} # Path -> number of times it has been pinned
+        self.sizes     = None # User folder (None for shared files) -> bytes, as of the last scan plus reservations and removals since; None until the first scan
+        self.lock      = threading.RLock()
+        self.stopper   = threading.Event()
+        self.thread    = None
+        if interval:
+            self.start()
+        return
+
+
+    def username(self):
+        ''' The name of the current user, or None if not in a request '''
+        if not has_request_context():
+            return None
+        try:
+            if current_user.is_authenticated:
+                return current_user.username
+        except Exception:
+            pass
+        return '_anonymous'
+
+
+    def userfolder(self, username=None):
+        ''' Return (and create) the folder for a user, by default the current user; the shared folder if there is none '''
+        if username is None:
+            username = self.username()
+        if username is None:
+            folder = self.folder
+        else:
+            folder = os.path.join(self.folder, 'users', self._dirname(username))
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+
+    @staticmethod
+    def _dirname(username):
+        ''' Convert a username to a safe folder name, using a hash if it isn't one already '''
+        dirname = secure_filename(username)
+        if dirname != username:
+            dirname = sc.sha(username).hexdigest()
+        return dirname
+
+
+    def path(self, filename=None, username=None):
+        ''' Return a path for a file in the user's folder, with a random name if none is given '''
+        if filename is None:
+            filename = str(sc.uuid())
+        return os.path.join(self.userfolder(username), filename)
+
+
+    def contains(self, path):
+        ''' Whether a path is inside this temp space '''
+        folder = os.path.abspath(self.folder)
+        try:
+            return os.path.commonpath([folder, os.path.abspath(path)]) == folder
+        except ValueError: # E.g. on different drives
+            return False
+
+
+    def touch(self, path):
+        ''' Mark a file as recently used, so it is evicted last '''
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return
+
+
+    def pin(self, path):
+        ''' Prevent a file from being evicted until it is released '''
+        path = os.path.abspath(path)
+        with self.lock:
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+        return path
+
+
+    def release(self, path, delete=True):
+        ''' Unpin a file, and by default delete it (unless something else still has it pinned) '''
+        path = os.path.abspath(path)
+        with self.lock:
+            count = self.pinned.pop(path, 0) - 1
+            if count > 0:
+                self.pinned[path] = count
+                return
+        if delete:
+            try:
+                size = os.stat(path).st_size
+                os.remove(path)
+            except OSError: # Probably already moved or removed
+                return
+            with self.lock:
+                if self.sizes is not None:
+                    user = self._owner(path)
+                    self.sizes[user] = max(0, self.sizes.get(user, 0) - size)
+        return
+
+
+    def release_on_close(self, response, path):
+        ''' Pin a file until a Flask response has been sent, then delete it '''
+        self.pin(path)
+        # Wrap the body rather than using response.call_on_close(), which isn't called for
+        # direct-passthrough responses such as those from send_file()
+        response.response = ClosingIterator(response.response, lambda: self.release(path))
+        return response
+
+
+    def _owner(self, path):
+        ''' The user folder that a path is in, or None if it's a shared file '''
+        usersfolder = os.path.abspath(os.path.join(self.folder, 'users'))
+        path = os.path.abspath(path)
+        if path.startswith(usersfolder + os.sep):
+            return os.path.relpath(path, usersfolder).split(os.sep)[0]
+        return None
+
+
+    def files(self):
+        ''' List the files in the temp space as (last used, size, path, username) tuples '''
+        output = []
+        for dirpath,dirnames,filenames in os.walk(self.folder):
+            username = self._owner(dirpath)
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError: # Removed in the meantime
+                    continue
+                output.append((stat.st_mtime, stat.st_size, os.path.abspath(path), username))
+        return output
+
+
+    def usage(self, username=None):
+        ''' Total size in bytes of the temp space, or of one user's folder '''
+        if username is not None: username = self._dirname(username)
+        return sum([size for mtime,size,path,user in self.files() if username is None or user == username])
+
+
+    def reserve(self, nbytes, username=None):
+        '''
+        Make room for a new file of nbytes for a user (by default the current user), evicting
+        the least recently used files if needed.
+
+        Usage is tracked as a running total, so the folder is only scanned when the new
+        file might not fit (or on the first call). Expired files are removed then and by
+        the background sweeper; without one, every call scans, so that maxage is applied.
+
+        :raises: QuotaExceededError if there is not enough room even after evicting everything unpinned
+        '''
+        if username is None:
+            username = self.username()
+        user = self._dirname(username) if username else None
+        for quota,which in [(self.userquota if user else None, 'user'), (self.quota, 'total')]:
+            if quota is not None and nbytes > quota:
+                errormsg = 'Cannot store %s bytes in temporary space: the %s quota is %s bytes' % (nbytes, which, quota)
+                raise QuotaExceededError(errormsg)
+        with self.lock:
+            if self.sizes is not None and (self.maxage is None or self.thread is not None):
+                total     = sum(self.sizes.values()) + nbytes
+                usertotal = self.sizes.get(user, 0) + nbytes
+                if (self.quota is None or total <= self.quota) and (self.userquota is None or user is None or usertotal <= self.userquota):
+                    self.sizes[user] = usertotal # Fits without evicting anything
+                    return
+        self._evict(extra=nbytes, user=user, die=True)
+        return
+
+
+    def sweep(self):
+        '''
+        Remove files older than maxage, then evict the least recently used files until
+        every quota is met.
+
+        :return: dict with the number of files and bytes removed
+        '''
+        return self._evict()
+
+
+    def _evict(self, extra=0, user=None, die=False):
+        ''' Remove expired files, then the oldest files over quota; extra bytes are counted against the given user '''
+        now = time.time()
+        with self.lock:
+            pinned = set(self.pinned.keys())
+        allfiles = self.files()
+        files = sorted([f for f in allfiles if f[2] not in pinned])
+        sizes = {}
+        for mtime,size,path,username in allfiles:
+            sizes[username] = sizes.get(username, 0) + size
+        sizes[user] = sizes.get(user, 0) + extra
+        total = sum(sizes.values())
+
+        removed = dict(files=0, bytes=0)
+        for mtime,size,path,username in files: # Oldest first
+            expired   = self.maxage is not None and now - mtime > self.maxage
+            overuser  = self.userquota is not None and username is not None and sizes[username] > self.userquota
+            overtotal = self.quota is not None and total > self.quota
+            if not (expired or overuser or overtotal):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if self.verbose: print('TempSpace: removed %s (%s bytes)' % (path, size))
+            sizes[username] -= size
+            total -= size
+            removed['files'] += 1
+            removed['bytes'] += size
+
+        usertotal = sizes.get(user, 0) if user is not None else 0
+        overquota = (self.quota is not None and total > self.quota) or (self.userquota is not None and usertotal > self.userquota)
+        if die and overquota:
+            sizes[user] -= extra # Not reserved after all
+            with self.lock:
+                self.sizes = sizes
+            errormsg = 'Cannot store %s bytes in temporary space: quota exceeded by files still in use' % extra
+            raise QuotaExceededError(errormsg)
+        with self.lock:
+            self.sizes = sizes # Including the bytes just reserved
+        return removed
+
+
+    def start(self):
+        ''' Start sweeping in a background thread '''
+        if self.thread is None or not self.thread.is_alive():
+            self.stopper.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True, name='TempSpace sweeper')
+            self.thread.start()
+        return
+
+
+    def stop(self):
+        ''' Stop the background sweeper '''
+        self.stopper.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return
+
+
+    def _run(self):
+        while not self.stopper.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as E:
+                print('TempSpace: sweep of %s failed: %s' % (self.folder, repr(E)))
+        return
@@ -4,6 +4,8 @@ user.py -- code related to Sciris user management
 Last update: 2018sep20
 """
 
+import uuid
+import datetime
 from flask import Flask, session, current_app as app # analysis:ignore
 from flask_login import current_user, login_user, logout_user
 import six
@@ -43,7 +45,18 @@ class User(sc.prettyobj):
         email (str)             -- the user's email     
         password (str)          -- the user's SHA224-hashed password
         raw_password (str)      -- the user's unhashed password
+
+    Users are stored by the DataStore as compact records rather than pickles (see
+    `sw_datastore.dumprecord()`): `_schema` lists the stored attributes and their types,
+    and new attributes must be appended to it (incrementing `_schemaversion`) so that
+    existing records can still be read. Attributes not in the schema can still be set,
+    but the user is then stored as a pickle.
     '''
+
+    __slots__ = ('username', 'displayname', 'email', 'uid', 'is_authenticated', 'is_active', 'is_anonymous', 'is_admin', 'created', 'modified', 'password') # Instances still have a __dict__, from sc.prettyobj, for any other attributes
+    _schemaversion = 1
+    _schema = (('username', str), ('displayname', str), ('email', str), ('uid', uuid.UUID), ('is_authenticated', bool), ('is_active', bool),
+               ('is_anonymous', bool), ('is_admin', bool), ('created', datetime.datetime), ('modified', datetime.datetime), ('password', str))
     
     def  __init__(self, username=None, password=None, displayname=None, email=None, uid=None, raw_password=None, is_admin=False):
         # Handle general properties
@@ -72,6 +85,21 @@ class User(sc.prettyobj):
         return
     
     
+    def __getstate__(self):
+        ''' Pickle the attributes as a dict, as for users saved before __slots__ were added '''
+        state = dict(self.__dict__)
+        for attr in self.__slots__:
+            if hasattr(self, attr):
+                state[attr] = getattr(self, attr)
+        return state
+    
+    
+    def __setstate__(self, state):
+        for attr,value in state.items():
+            setattr(self, attr, value)
+        return
+    
+    
     def get_id(self):
         ''' Method required by Flask-login '''
         return self.username
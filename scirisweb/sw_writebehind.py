@@ -0,0 +1,302 @@
+"""
+sw_writebehind.py -- buffering writes to a DataStore
+
+WriteBehindDataStore wraps any DataStore, keeps writes in memory (so repeated writes
+to a key are coalesced), and flushes them in batches from a background thread;
+`sw.make_datastore(url, writebehind=interval)` creates one.
+"""
+
+import time
+import atexit
+import fnmatch
+import collections
+import threading
+import sciris as sc
+from .sw_datastore import make_datastore, BaseDataStore
+
+deleted_marker = object() # Placeholder for a pending deletion in WriteBehindDataStore
+
+__all__ = ['WriteBehindDataStore']
+
+
+class WriteBehindDataStore(BaseDataStore):
+    """
+    Wrapper around any other datastore that buffers writes in memory and flushes them in
+    the background.
+
+    Repeated writes to the same key are coalesced so only the latest is written, and
+    pending writes are flushed in batches (using the backend's `_setmany()` and
+    `_deletemany()`) every interval seconds, when there are more than maxpending of them,
+    when `flush()` is called, and at exit. Reads through this datastore see pending
+    writes; other processes see them only after they have been flushed, and pending
+    writes are lost if the process is killed. This is intended for data where losing
+    the last few seconds of writes is acceptable, such as progress checkpoints.
+
+    :param datastore: The datastore to wrap, or a URL to pass to `make_datastore()`
+    :param interval: Seconds between background flushes (default 1)
+    :param maxpending: If set, flush immediately once this many keys are pending
+
+    Example:
+        ds = sw.WriteBehindDataStore(sw.make_datastore('redis://127.0.0.1:6379/0'), interval=0.5)
+        ds = sw.make_datastore('redis://127.0.0.1:6379/0', writebehind=0.5) # Equivalent
+    """
+
+    def __init__(self, datastore, interval=None, maxpending=None, *args, **kwargs):
+        if interval is None: interval = 1.0
+        if sc.isstring(datastore) or isinstance(datastore, (list, tuple)):
+            datastore = make_datastore(datastore, verbose=kwargs.get('verbose', True))
+        self.datastore  = datastore
+        self.url        = getattr(datastore, 'url', None)
+        self.interval   = interval
+        self.maxpending = maxpending
+        self.pending    = collections.OrderedDict() # Key -> objstr, or deleted_marker
+        self.flushing   = {} # Writes currently being flushed, still visible to reads
+        self.lock       = threading.RLock() # For pending and flushing
+        self.flushlock  = threading.Lock() # Only one flush at a time
+        self.wakeup     = threading.Event()
+        self.stopped    = False
+
+        # Finish construction, using the wrapped datastore's settings
+        kwargs.setdefault('tempfolder', datastore.tempfolder)
+        kwargs.setdefault('separator',  datastore.separator)
+        kwargs.setdefault('codec',      datastore.codec)
+        kwargs.setdefault('records',    datastore.records)
+        kwargs.setdefault('changefeed', datastore.changefeed and datastore.feedlength)
+        kwargs.setdefault('accounting', datastore.accounting)
+        kwargs.setdefault('quota',      datastore.quota)
+        kwargs.setdefault('identitymap', datastore.identitymap)
+        super().__init__(*args, **kwargs)
+        self.metrics.describe('writebehind_pending',       'gauge',   'Number of keys waiting to be flushed')
+        self.metrics.describe('writebehind_coalesced_total', 'counter', 'Writes replaced by a later write before being flushed')
+        self.metrics.describe('writebehind_flushed_total', 'counter', 'Keys flushed to the backend')
+
+        # Start flushing in the background
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        return
+
+
+    def __repr__(self):
+        return '<WriteBehindDataStore (%s keys pending) over %s>' % (len(self.pending), repr(self.datastore))
+
+
+    ### BUFFERING
+
+    def _buffer(self, key, objstr):
+        ''' Add a write (or deletion) to the pending writes '''
+        with self.lock:
+            if self.pending.pop(key, None) is not None:
+                self.metrics.inc('writebehind_coalesced_total')
+            self.pending[key] = objstr
+            npending = len(self.pending)
+        self.metrics.set('writebehind_pending', npending)
+        if self.maxpending is not None and npending >= self.maxpending:
+            self.flush() # Apply backpressure rather than letting the buffer grow
+        return
+
+
+    def _lookup(self, key):
+        ''' Return (True, objstr or None) if the key has a pending write, else (False, None) '''
+        with self.lock:
+            for buffer in [self.pending, self.flushing]:
+                if key in buffer:
+                    objstr = buffer[key]
+                    return True, (None if objstr is deleted_marker else objstr)
+        return False, None
+
+
+    def _overlay(self):
+        ''' A snapshot of all writes not yet in the backend '''
+        with self.lock:
+            overlay = dict(self.flushing)
+            overlay.update(self.pending)
+        return overlay
+
+
+    def flush(self):
+        ''' Write all pending changes to the wrapped datastore; returns the number of keys written '''
+        with self.flushlock:
+            with self.lock:
+                if not self.pending: return 0
+                self.flushing = self.pending
+                self.pending  = collections.OrderedDict()
+            batch = self.flushing
+            writes  = [(key,objstr) for key,objstr in batch.items() if objstr is not deleted_marker]
+            deletes = [key for key,objstr in batch.items() if objstr is deleted_marker]
+            try:
+                t0 = time.perf_counter()
+                if writes:  self.datastore._setmany(writes)
+                if deletes: self.datastore._deletemany(deletes)
+                self._record('flush', time.perf_counter()-t0, nbytes=sum([len(objstr) for key,objstr in writes]))
+                super()._publish([(key, 'delete' if objstr is deleted_marker else 'set') for key,objstr in batch.items()])
+                self.metrics.inc('writebehind_flushed_total', len(batch))
+            except Exception as E:
+                with self.lock: # Put back anything that hasn't been overwritten since, so it's retried next time
+                    for key,objstr in batch.items():
+                        if key not in self.pending:
+                            self.pending[key] = objstr
+                self.metrics.inc('errors_total', op='flush')
+                print('DataStore: write-behind flush of %s keys failed, will retry: %s' % (len(batch), str(E)))
+                return 0
+            finally:
+                with self.lock:
+                    self.flushing = {}
+                self.metrics.set('writebehind_pending', len(self.pending))
+        return len(batch)
+
+
+    def _run(self):
+        ''' Background thread: flush every interval seconds until closed '''
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as E:
+                print('DataStore: write-behind flush failed: %s' % str(E))
+        return
+
+
+    def close(self):
+        ''' Stop the background thread and flush any remaining writes '''
+        if not self.stopped:
+            self.stopped = True
+            self.wakeup.set()
+            self.thread.join(timeout=max(self.interval, 1.0)*2)
+            atexit.unregister(self.close) # So closed wrappers aren't kept alive until exit
+        self.flush()
+        return
+
+
+    ### DEFINE MANDATORY FUNCTIONS
+
+    def _set(self, key, objstr):
+        self._buffer(key, objstr)
+        return
+
+
+    def _get(self, key):
+        found,objstr = self._lookup(key)
+        return objstr if found else self.datastore._get(key)
+
+
+    def _delete(self, key):
+        self._buffer(key, deleted_marker)
+        return
+
+
+    def _flushdb(self):
+        with self.flushlock:
+            with self.lock:
+                self.pending.clear()
+            self.datastore._flushdb()
+        return
+
+
+    def _keys(self):
+        return self.keys()
+
+
+    ### OVERLOAD ADDITIONAL METHODS TO INCLUDE PENDING WRITES
+
+    def keys(self, pattern=None):
+        overlay = self._overlay()
+        keys = [key for key in self.datastore.keys(pattern=pattern) if overlay.get(key) is not deleted_marker]
+        existing = set(keys)
+        for key,objstr in overlay.items():
+            if objstr is not deleted_marker and key not in existing and (pattern is None or fnmatch.fnmatch(key, pattern)):
+                keys.append(key)
+        return keys
+
+
+    def iterkeys(self, pattern=None, batch=None):
+        overlay = self._overlay()
+        for key in self.datastore.iterkeys(pattern=pattern, batch=batch):
+            if key not in overlay:
+                yield key
+        for key,objstr in overlay.items():
+            if objstr is not deleted_marker and (pattern is None or fnmatch.fnmatch(key, pattern)):
+                yield key
+
+
+    def exists(self, key):
+        found,objstr = self._lookup(key)
+        return (objstr is not None) if found else self.datastore.exists(key)
+
+
+    def _getmany(self, keys):
+        output = [None]*len(keys)
+        missing = []
+        for i,key in enumerate(keys):
+            found,objstr = self._lookup(key)
+            if found: output[i] = objstr
+            else:     missing.append(i)
+        if missing:
+            for i,objstr in zip(missing, self.datastore._getmany([keys[i] for i in missing])):
+                output[i] = objstr
+        return output
+
+
+    def _setmany(self, items):
+        for key,objstr in items:
+            self._buffer(key, objstr)
+        return
+
+
+    def _deletemany(self, keys):
+        for key in keys:
+            self._buffer(key, deleted_marker)
+        return
+
+
+    ### MAINTENANCE
+
+    def _compact(self, throttle, full):
+        self.flush()
+        return self.datastore._compact(throttle, full)
+
+
+    def _deletepattern(self, pattern, batch, ondelete=None):
+        self.flush() # So pending writes to matching keys are deleted too
+        return self.datastore._deletepattern(pattern, batch, ondelete)
+
+
+    ### ACCOUNTING, KEPT BY THE WRAPPED DATASTORE WHEN WRITING; CHANGE FEED, PUBLISHED TO IT WHEN FLUSHING
+
+    def _makeaccountant(self):
+        if self.datastore.accountant is None:
+            self.datastore.accountant = self.datastore._makeaccountant()
+        return self.datastore.accountant
+
+
+    def _publish(self, changes):
+        return # Changes are published by flush(), once other processes can see them
+
+
+    def _initchangefeed(self):
+        self.feedcond = self.datastore.feedcond
+        if not self.datastore.changefeed:
+            self.datastore.feedlength = self.feedlength
+            self.datastore._initchangefeed()
+        return
+
+
+    def _appendchanges(self, changes):
+        return self.datastore._appendchanges(changes)
+
+
+    def _lastversion(self):
+        return self.datastore._lastversion()
+
+
+    def _hasversion(self, version):
+        return self.datastore._hasversion(version)
+
+
+    def _fetchchanges(self, since, limit):
+        return self.datastore._fetchchanges(since, limit)
+
+
+    def _readchanges(self, since, limit, timeout):
+        return self.datastore._readchanges(since, limit, timeout)
@@ -0,0 +1,269 @@
+"""
+benchmark_datastore.py -- benchmarks for the DataStore backends
+
+Compares SQLDataStore (SQLite), FileDataStore (temporary folder), and RedisDataStore
+(a local redis-server, if one is on the path) across object sizes, key counts, read/write
+mixes, and thread/process concurrency. Results are written as JSON so that runs on
+different commits can be compared.
+
+Usage:
+    python benchmark_datastore.py                       # Full sweep
+    python benchmark_datastore.py --quick               # Small sweep, e.g. for a smoke test
+    python benchmark_datastore.py --backends sql file   # Only some backends
+    python benchmark_datastore.py --output results.json # Choose where to save the results
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import sciris as sc
+import scirisweb as sw
+
+
+# Sweep definitions
+full_sweep = dict(
+    sizes       = [100, 10_000, 1_000_000], # Approximate object size in bytes
+    nkeys       = [10, 100, 1000],
+    readfracs   = [0.5, 0.9, 1.0],
+    concurrency = [('thread', 1), ('thread', 4), ('thread', 16), ('process', 4)],
+    mixops      = 200, # Number of operations per worker in the mixed workload
+)
+
+quick_sweep = dict(
+    sizes       = [100, 100_000],
+    nkeys       = [10, 100],
+    readfracs   = [0.9],
+    concurrency = [('thread', 1), ('thread', 4), ('process', 2)],
+    mixops      = 50,
+)
+
+max_bytes = 200e6 # Skip combinations that would write more than this per backend
+
+
+#################################################################
+### Backends
+#################################################################
+
+def find_port():
+    ''' Find a free local port '''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Backends(sc.prettyobj):
+    ''' Create (and clean up) the temporary backends to benchmark '''
+
+    def __init__(self, which=None):
+        if which is None: which = ['sql', 'file', 'redis']
+        self.folder = tempfile.mkdtemp(prefix='sw_benchmark_')
+        self.redis_proc = None
+        self.urls = sc.odict()
+        if 'sql' in which:
+            self.urls['sql'] = 'sqlite:///%s' % os.path.join(self.folder, 'datastore.db')
+        if 'file' in which:
+            self.urls['file'] = 'file://%s' % os.path.join(self.folder, 'files')
+        if 'redis' in which:
+            url = self.start_redis()
+            if url: self.urls['redis'] = url
+        return
+
+    def start_redis(self):
+        ''' Start a throwaway redis-server, if one is available '''
+        exe = shutil.which('redis-server')
+        if exe is None:
+            print('Skipping Redis: redis-server not found')
+            return None
+        port = find_port()
+        cmd = [exe, '--port', str(port), '--save', '', '--appendonly', 'no', '--dir', self.folder]
+        self.redis_proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = 'redis://127.0.0.1:%s/0' % port
+        for i in range(50): # Wait up to 5 s for it to start
+            try:
+                sw.make_datastore(url, verbose=False, redisargs={'socket_connect_timeout':0.1})
+                return url
+            except Exception:
+                time.sleep(0.1)
+        print('Skipping Redis: redis-server did not start')
+        self.redis_proc.terminate()
+        self.redis_proc = None
+        return None
+
+    def cleanup(self):
+        if self.redis_proc is not None:
+            self.redis_proc.terminate()
+            self.redis_proc.wait()
+        shutil.rmtree(self.folder, ignore_errors=True)
+        return
+
+
+#################################################################
+### Benchmarks
+#################################################################
+
+def make_payload(size, seed=0):
+    ''' Make an object that pickles to roughly the requested number of bytes (random, so it doesn't compress) '''
+    rng = np.random.default_rng(seed)
+    return rng.random(max(1, size//8))
+
+
+def summarize(times, **kwargs):
+    ''' Convert a list of per-operation timings (in seconds) into a result record '''
+    times = np.array(times)
+    total = float(times.sum())
+    output = dict(kwargs)
+    output.update(
+        n         = len(times),
+        total_s   = total,
+        ops_per_s = len(times)/total if total else None,
+        mean_ms   = float(times.mean()*1e3),
+        p50_ms    = float(np.percentile(times, 50)*1e3),
+        p95_ms    = float(np.percentile(times, 95)*1e3),
+        p99_ms    = float(np.percentile(times, 99)*1e3),
+    )
+    return output
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+def bench_ops(ds, size, nkeys):
+    ''' Benchmark each operation on its own, single-threaded '''
+    payload = make_payload(size)
+    keys = ['bench%s%05i' % (ds.separator, i) for i in range(nkeys)]
+    blobkeys = ['benchblob%s%05i' % (ds.separator, i) for i in range(nkeys)]
+    times = sc.odict()
+    times['set']      = [timeit(ds.set, key, payload) for key in keys]
+    times['get']      = [timeit(ds.get, key) for key in keys]
+    times['saveblob'] = [timeit(ds.saveblob, payload, key=key) for key in blobkeys]
+    times['loadblob'] = [timeit(ds.loadblob, key) for key in blobkeys]
+    times['saveuser'] = [timeit(ds.saveuser, sw.User(username='bench%05i' % i)) for i in range(nkeys)]
+    times['loaduser'] = [timeit(ds.loaduser, 'bench%05i' % i) for i in range(nkeys)]
+    times['savetask'] = [timeit(ds.savetask, sw.Task('bench%05i' % i)) for i in range(nkeys)]
+    times['loadtask'] = [timeit(ds.loadtask, 'bench%05i' % i) for i in range(nkeys)]
+    times['keys']     = [timeit(ds.keys, 'bench*') for i in range(5)]
+    times['items']    = [timeit(ds.items, 'bench%s*' % ds.separator) for i in range(2)]
+    return times
+
+
+def mixed_worker(url, keys, nops, readfrac, size, seed):
+    ''' Run a random mix of reads and writes; used by both threads and processes '''
+    ds = sw.make_datastore(url, verbose=False)
+    rng = random.Random(seed)
+    payload = make_payload(size, seed=seed)
+    times = []
+    errors = 0
+    for i in range(nops):
+        key = rng.choice(keys)
+        try:
+            if rng.random() < readfrac: times.append(timeit(ds.get, key))
+            else:                       times.append(timeit(ds.set, key, payload))
+        except Exception:
+            errors += 1
+    return times, errors
+
+
+def bench_mixed(url, ds, size, nkeys, readfrac, mode, nworkers, nops):
+    ''' Benchmark a read/write mix with thread or process concurrency '''
+    keys = ['bench%s%05i' % (ds.separator, i) for i in range(nkeys)]
+    args = [(url, keys, nops, readfrac, size, seed) for seed in range(nworkers)]
+    t0 = time.perf_counter()
+    if mode == 'thread':
+        with ThreadPoolExecutor(max_workers=nworkers) as pool:
+            outputs = list(pool.map(lambda a: mixed_worker(*a), args))
+    else:
+        with mp.get_context('spawn').Pool(nworkers) as pool:
+            outputs = pool.starmap(mixed_worker, args)
+    wall = time.perf_counter() - t0
+    times = sum([o[0] for o in outputs], [])
+    errors = sum([o[1] for o in outputs])
+    return times, errors, wall
+
+
+def run(sweep=None, backends=None, verbose=True):
+    ''' Run the full benchmark sweep and return the results as a dict '''
+    if sweep is None: sweep = full_sweep
+    bk = Backends(backends)
+    results = []
+    backend_stats = {}
+    try:
+        for name,url in bk.urls.items():
+            for size in sweep['sizes']:
+                for nkeys in sweep['nkeys']:
+                    if size*nkeys*2 > max_bytes: # Skip combinations that are too big
+                        continue
+                    ds = sw.make_datastore(url, verbose=False)
+                    ds.flushdb()
+                    ds = sw.make_datastore(url, verbose=False)
+                    common = dict(backend=name, size=size, nkeys=nkeys)
+                    if verbose: print('Benchmarking %s: size=%s, nkeys=%s' % (name, size, nkeys))
+
+                    # Single operations
+                    for op,times in bench_ops(ds, size, nkeys).items():
+                        results.append(summarize(times, op=op, mode='thread', workers=1, readfrac=None, **common))
+
+                    # Mixed workloads
+                    for readfrac in sweep['readfracs']:
+                        for mode,nworkers in sweep['concurrency']:
+                            times, errors, wall = bench_mixed(url, ds, size, nkeys, readfrac, mode, nworkers, sweep['mixops'])
+                            if not times: continue
+                            result = summarize(times, op='mixed', mode=mode, workers=nworkers, readfrac=readfrac, **common)
+                            result.update(errors=errors, wall_s=wall, throughput_ops_per_s=len(times)/wall)
+                            results.append(result)
+
+                    backend_stats['%s_size%s_nkeys%s' % (name, size, nkeys)] = ds.stats()
+                    ds.flushdb()
+    finally:
+        bk.cleanup()
+
+    output = dict(meta=metadata(sweep), results=results, stats=backend_stats)
+    return output
+
+
+def metadata(sweep):
+    ''' Information needed to compare results across runs '''
+    try:    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except: commit = None
+    meta = dict(
+        commit    = commit,
+        timestamp = sc.now(astype='str'),
+        python    = sys.version.split()[0],
+        platform  = platform.platform(),
+        cpus      = os.cpu_count(),
+        scirisweb = sw.__version__,
+        sciris    = sc.__version__,
+        sweep     = sweep,
+    )
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ScirisWeb DataStore backends')
+    parser.add_argument('--quick', action='store_true', help='run a small sweep')
+    parser.add_argument('--backends', nargs='+', default=None, choices=['sql', 'file', 'redis'], help='backends to benchmark (default: all available)')
+    parser.add_argument('--output', default='benchmark_datastore.json', help='file to write the JSON results to')
+    args = parser.parse_args()
+    sweep = quick_sweep if args.quick else full_sweep
+    output = run(sweep=sweep, backends=args.backends)
+    with open(args.output, 'w') as f:
+        json.dump(sc.sanitizejson(output), f, indent=2)
+    print('Saved %s results to %s' % (len(output['results']), args.output))
+    return output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+benchmark_rpc.py -- benchmark of the per-call overhead of RPC dispatch
+
+Times a no-op RPC (and a few variants) through ScirisApp, so that changes to the
+dispatcher can be compared. Each case reports calls per second and microseconds per
+call for:
+
+    dispatch -- ScirisApp._do_RPC() called repeatedly inside one request context
+    http     -- a full POST to /rpcs through the Flask test client
+
+It also times encoding a result with a million floats as a JSON response, compared
+with sc.sanitizejson(), and a page's worth of calls sent as separate requests compared
+with one request to /rpcs/batch.
+
+Usage:
+    python benchmark_rpc.py                        # Default number of calls
+    python benchmark_rpc.py --ncalls 20000         # More calls, for steadier numbers
+    python benchmark_rpc.py --output results.json  # Also save the results
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import numpy as np
+import sciris as sc
+import scirisweb as sw
+
+
+def make_app(users=False, logging='OFF'):
+    ''' Make an app with a no-op RPC, with or without users, and with or without per-call logging '''
+    config = sw.TestingUsersAppConfig() if users else sw.Config()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        app = sw.ScirisApp(__file__, config=config, name='benchmark_rpc', LOGGING_MODE=logging)
+
+    @app.register_RPC(validation='none')
+    def noop():
+        return None
+
+    @app.register_RPC(validation='none')
+    def echo(x, y=None):
+        return {'x':x, 'y':y}
+
+    @app.register_RPC(validation='any')
+    def noop_any():
+        return None
+
+    return app
+
+
+def bench(app, payload, ncalls, mode):
+    ''' Time ncalls calls of an RPC; return seconds per call '''
+    data = json.dumps(payload)
+    with contextlib.redirect_stdout(open(os.devnull, 'w')): # Logged calls print each call
+        if mode == 'dispatch':
+            with app.flask_app.test_request_context('/rpcs', method='POST', data=data, content_type='application/json'):
+                app._do_RPC() # Warm up
+                t0 = time.perf_counter()
+                for i in range(ncalls):
+                    app._do_RPC()
+                elapsed = time.perf_counter() - t0
+        else:
+            with app.flask_app.test_client() as client:
+                client.post('/rpcs', data=data, content_type='application/json')
+                t0 = time.perf_counter()
+                for i in range(ncalls):
+                    client.post('/rpcs', data=data, content_type='application/json')
+                elapsed = time.perf_counter() - t0
+    return elapsed/ncalls
+
+
+def bench_json(app, n=1_000_000, repeats=3):
+    ''' Time converting a result with n floats to a JSON response; return the best of several repeats, in seconds '''
+    result = {'x':np.random.rand(n), 'name':'floats'}
+    times = dict(robustjsonify=[], sanitizejson=[])
+    with app.flask_app.app_context():
+        for i in range(repeats):
+            t0 = time.perf_counter()
+            sw.robustjsonify(result)
+            t1 = time.perf_counter()
+            sc.sanitizejson(result, tostring=True)
+            t2 = time.perf_counter()
+            times['robustjsonify'].append(t1-t0)
+            times['sanitizejson'].append(t2-t1)
+    return {k:min(v) for k,v in times.items()}
+
+
+def bench_batch(app, ncalls=20, repeats=20):
+    ''' Time ncalls echo calls as separate requests and as one batch; return the best of several repeats, in seconds '''
+    calls = [{'funcname':'echo', 'args':[i]} for i in range(ncalls)]
+    times = dict(separate=[], batch=[])
+    with app.flask_app.test_client() as client:
+        for i in range(repeats):
+            t0 = time.perf_counter()
+            for call in calls:
+                client.post('/rpcs', json=call)
+            t1 = time.perf_counter()
+            client.post('/rpcs/batch', json=calls)
+            t2 = time.perf_counter()
+            times['separate'].append(t1-t0)
+            times['batch'].append(t2-t1)
+    return {k:min(v) for k,v in times.items()}
+
+
+def run(ncalls=5000, verbose=True):
+    cases = [
+        ('noop',            dict(users=False, logging='OFF'),  {'funcname':'noop'}),
+        ('noop, logged',    dict(users=False, logging='FULL'), {'funcname':'noop'}),
+        ('echo',            dict(users=False, logging='OFF'),  {'funcname':'echo', 'args':[1], 'kwargs':{'y':[1, 2, 3]}}),
+        ('noop, users',     dict(users=True,  logging='OFF'),  {'funcname':'noop'}),
+        ('noop_any, users', dict(users=True,  logging='OFF'),  {'funcname':'noop_any'}),
+        ('noop_any, logged', dict(users=True, logging='FULL'), {'funcname':'noop_any'}),
+    ]
+    results = []
+    for name,appargs,payload in cases:
+        app = make_app(**appargs)
+        for mode in ['dispatch', 'http']:
+            n = ncalls if mode == 'dispatch' else max(1, ncalls//5)
+            seconds = bench(app, payload, n, mode)
+            result = dict(case=name, mode=mode, ncalls=n, us_per_call=seconds*1e6, calls_per_s=1/seconds)
+            results.append(result)
+            if verbose: print('%-16s %-8s %9.1f µs/call %10.0f calls/s' % (name, mode, result['us_per_call'], result['calls_per_s']))
+    json_s = bench_json(app)
+    if verbose: print('JSON, 1M floats:  %0.3f s (sc.sanitizejson: %0.3f s)' % (json_s['robustjsonify'], json_s['sanitizejson']))
+    batch_s = bench_batch(make_app(users=True))
+    if verbose: print('20 calls, users:  %0.2f ms as one batch (separately: %0.2f ms)' % (batch_s['batch']*1e3, batch_s['separate']*1e3))
+    return dict(python=sys.version.split()[0], created=sc.now(astype='str'), results=results, json=json_s, batch=batch_s)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ncalls', type=int, default=5000, help='number of calls per case in dispatch mode (a fifth of this over HTTP)')
+    parser.add_argument('--output', default=None, help='file to save the results to as JSON')
+    args = parser.parse_args()
+    output = run(ncalls=args.ncalls)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print('Results saved to %s' % args.output)
@@ -2,11 +2,17 @@
 test_app.py -- test module for sw_app.py
 """
 
+import io
 import os
+import time
+import datetime
+import threading
 import pytest
+import numpy as np
 import sciris as sc
 import scirisweb as sw
 import pylab as pl
+from flask_login import current_user
 
 
 
@@ -58,6 +64,254 @@ def test_robustjsonify(app):
         response = sw.robustjsonify(info)
         assert response.status_code == 200
         assert response.is_json == True
+        assert list(response.get_json().keys()) == ['data1', 'data2', 'data3']
+
+        # NumPy data, odicts, and datetimes are encoded directly; NaN becomes null
+        data = sc.odict(z=np.array([1.5, np.nan]), y=np.int64(3), x=datetime.datetime(2020, 1, 2), w={1:(2, 3)})
+        assert sw.robustjsonify(data).get_data() == b'{"z":[1.5,null],"y":3,"x":"2020-01-02T00:00:00","w":{"1":[2,3]}}\n'
+        assert sw.robustjsonify({None:1}).get_json() == {'None':1} # Falls back to sc.sanitizejson()
+
+
+def test_rpc_dispatch():
+    app = sw.ScirisApp(__name__, config=sw.Config(), LOGGING_MODE='OFF')
+
+    @app.register_RPC()
+    def add(x, y=0):
+        return {'sum':x+y}
+
+    @app.register_RPC()
+    def fail():
+        raise ValueError('failed')
+
+    @app.register_RPC(validation='disabled')
+    def disabled():
+        return 'never'
+
+    with app.flask_app.test_client() as client:
+        assert client.post('/rpcs', json={'funcname':'add', 'args':[1], 'kwargs':{'y':2}}).get_json() == {'sum':3}
+        assert client.post('/rpcs', json={'funcname':'missing'}).get_json() == {'error':'Could not find requested RPC "missing"'}
+        assert client.post('/rpcs', json={'funcname':'disabled'}).status_code == 403
+        response = client.post('/rpcs', json={'funcname':'fail'})
+        assert response.status_code == 500 and 'failed' in response.get_json()['exception']
+
+        # RPCs put straight into the dictionary are compiled on their first call
+        app.RPC_dict['add'] = sw.ScirisRPC(lambda x, y=0: {'sum':x*y}, override=True)
+        assert client.post('/rpcs', json={'funcname':'add', 'args':[2, 3]}).get_json() == {'sum':6}
+
+
+def test_rpc_formats():
+    app = sw.ScirisApp(__name__, config=sw.Config(), LOGGING_MODE='OFF')
+
+    x = np.random.rand(1000)
+
+    @app.register_RPC()
+    def results():
+        return {'x':x, 'y':np.arange(6, dtype='>i4').reshape(2, 3), 'label':'data', 'items':[1, 'a']}
+
+    with app.flask_app.test_client() as client:
+        response = client.post('/rpcs', json={'funcname':'results'})
+        assert response.mimetype == 'application/json' # The default
+        jsonsize = len(response.data)
+
+        # Arrays are sent as raw buffers in the binary formats
+        for mimetype in ['application/msgpack', 'application/vnd.sciris.arrays']:
+            response = client.post('/rpcs', json={'funcname':'results'}, headers={'Accept':mimetype})
+            assert response.mimetype == mimetype and 'Accept' in response.headers['Vary']
+            assert len(response.data) < jsonsize/2
+            output = sw.unpackresult(response.data, mimetype)
+            assert np.array_equal(output['x'], x)
+            assert output['y'].dtype == np.dtype('<i4') and output['y'].tolist() == [[0, 1, 2], [3, 4, 5]]
+            assert output['label'] == 'data' and output['items'] == [1, 'a']
+
+
+def test_rpc_stream():
+    app = sw.ScirisApp(__name__, config=sw.Config(), LOGGING_MODE='OFF')
+    produced = []
+
+    @app.register_RPC(call_type='stream')
+    def rows(n, fail=False):
+        for i in range(n):
+            produced.append(i)
+            yield {'i':i, 'x':np.arange(2)*i}
+        if fail:
+            raise ValueError('failed')
+
+    with app.flask_app.test_client() as client:
+
+        # Items are sent one per line as they are produced
+        response = client.post('/rpcs', json={'funcname':'rows', 'args':[1000]}, buffered=False)
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.iter_encoded()
+        assert sc.loadjson(string=next(lines).decode()) == {'i':0, 'x':[0, 0]}
+        assert len(produced) < 1000
+        assert len(list(lines)) == 999
+        response.close()
+
+        # Or as a JSON array, ending with the exception if there is one
+        response = client.post('/rpcs', json={'funcname':'rows', 'args':[2], 'kwargs':{'fail':True}}, headers={'Accept':'application/json'})
+        output = response.get_json()
+        assert output[:2] == [{'i':0, 'x':[0, 0]}, {'i':1, 'x':[0, 1]}]
+        assert 'failed' in output[2]['exception']
+
+
+def test_rpc_cache():
+    app = sw.ScirisApp(__name__, config=sw.TestingAppConfig(), LOGGING_MODE='OFF')
+    calls = []
+
+    @app.register_RPC(cache=dict(maxsize=2))
+    def square(x):
+        calls.append(x)
+        return {'y':x**2}
+
+    @app.register_RPC(cache=dict(ttl=0, store='datastore'))
+    def expiring(x):
+        calls.append(x)
+        return {'y':x}
+
+    with app.flask_app.test_client() as client:
+        call = lambda name, x: client.post('/rpcs', json={'funcname':name, 'args':[x]}).get_json()
+
+        # Repeated calls are answered from the cache, up to the maximum size
+        assert [call('square', x)['y'] for x in [1, 2, 1, 3, 1, 2]] == [1, 4, 1, 9, 1, 4]
+        assert calls == [1, 2, 3, 2]
+        stats = app.cache_stats()['square']
+        assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (2, 4, 2, 2)
+
+        # Invalidating one call or all of them
+        assert app.invalidate_RPC('square', args=[1]) == 1
+        call('square', 1)
+        assert calls[-1] == 1
+        square.cache.invalidate()
+        assert square.cache.stats()['size'] == 0
+
+        # Expired results in the datastore are recomputed
+        calls.clear()
+        call('expiring', 5)
+        call('expiring', 5)
+        assert calls == [5, 5]
+        assert len(app.datastore.keys('rpccache*')) == 1
+        expiring.cache.nextsweep = 0 # Due, so the next result stored sweeps the expired ones (with a TTL of 0, that's all of them)
+        call('expiring', 6)
+        assert app.datastore.keys('rpccache*') == []
+        call('expiring', 6)
+        with app.flask_app.app_context():
+            assert expiring.cache.sweep() == 1
+            assert app.datastore.keys('rpccache*') == []
+        assert app.invalidate_RPC('expiring', args=[6]) == 1 # Without checking whether it was cached
+
+    # Arguments that aren't JSON, e.g. from Python, are hashed by pickling them
+    assert square.cache.hash([np.arange(3)], {}) == square.cache.hash([np.arange(3)], {}) != square.cache.hash([np.arange(4)], {})
+
+    with pytest.raises(ValueError):
+        sw.ScirisRPC(square, call_type='download', cache=True)
+
+
+def test_rpc_httpcache():
+    app = sw.ScirisApp(__name__, config=sw.Config(), LOGGING_MODE='OFF')
+    calls = []
+    versions = {'a':1}
+
+    @app.register_RPC()
+    def nocache():
+        return {'x':1}
+
+    @app.register_RPC(httpcache=True)
+    def hashed(x):
+        calls.append(x)
+        return {'y':x}
+
+    @app.register_RPC(httpcache=dict(etag=lambda name: versions[name]))
+    def versioned(name):
+        calls.append(name)
+        return {'version':versions[name]}
+
+    @app.register_RPC(httpcache=dict(max_age=3600, immutable=True))
+    def immutable():
+        return {'z':3}
+
+    with app.flask_app.test_client() as client:
+        post = lambda name, args, **kw: client.post('/rpcs', json={'funcname':name, 'args':args}, **kw)
+
+        # By default, nothing is cached, and RPCs can't be called with GET
+        response = post('nocache', [])
+        assert response.headers['Cache-Control'] == 'no-cache, no-store, must-revalidate'
+        assert 'ETag' not in response.headers
+        assert client.get('/rpcs?funcname=nocache').status_code == 405
+
+        # A hash of the body: a matching If-None-Match gets a 304 with no body
+        response = post('hashed', [1])
+        etag = response.headers['ETag']
+        assert 'no-cache' in response.headers['Cache-Control'] and 'no-store' not in response.headers['Cache-Control']
+        response = post('hashed', [1], headers={'If-None-Match':etag})
+        assert response.status_code == 304 and response.data == b''
+        assert post('hashed', [2], headers={'If-None-Match':etag}).status_code == 200
+
+        # A version: the RPC isn't run if the client has the current version
+        calls.clear()
+        etag = post('versioned', ['a']).headers['ETag']
+        assert post('versioned', ['a'], headers={'If-None-Match':etag}).status_code == 304
+        assert calls == ['a']
+        versions['a'] = 2
+        response = post('versioned', ['a'], headers={'If-None-Match':etag})
+        assert response.status_code == 200 and response.get_json() == {'version':2}
+
+        # Immutable results, called with GET so the browser can cache them
+        response = client.get('/rpcs?funcname=immutable')
+        assert response.get_json() == {'z':3}
+        assert response.cache_control.max_age == 3600 and response.cache_control.immutable
+        response = client.get('/rpcs?funcname=hashed&args=[4]', headers={'If-None-Match':post('hashed', [4]).headers['ETag']})
+        assert response.status_code == 304
+
+    with pytest.raises(ValueError):
+        sw.ScirisRPC(hashed, call_type='stream', httpcache=True)
+
+
+def test_rpc_batch():
+    app = sw.ScirisApp(__name__, config=sw.TestingUsersAppConfig(), LOGGING_MODE='OFF')
+    threads = set()
+
+    @app.register_RPC()
+    def whoami(x):
+        threads.add(threading.get_ident())
+        time.sleep(0.05)
+        return {'x':x, 'anonymous':current_user.is_anonymous}
+
+    @app.register_RPC(validation='named')
+    def private():
+        return 'secret'
+
+    @app.register_RPC()
+    def fails(kind):
+        if kind == 'error': return {'error':'bad input'}
+        raise ValueError('oops')
+
+    loads = []
+    load_user = app.login_manager._load_user
+    def counting_load_user():
+        loads.append(threading.get_ident())
+        return load_user()
+    app.login_manager._load_user = counting_load_user
+
+    calls = [{'funcname':'whoami', 'args':[i]} for i in range(4)]
+    calls += [{'funcname':'private'}, {'funcname':'private'}, {'funcname':'fails', 'args':['error']}, {'funcname':'fails', 'kwargs':{'kind':'raise'}}, {'funcname':'missing'}]
+    with app.flask_app.test_client() as client:
+        for parallel in [False, True]:
+            threads.clear()
+            loads.clear()
+            output = client.post('/rpcs/batch', json={'calls':calls, 'parallel':parallel}).get_json()
+            assert [item['result']['x'] for item in output[:4]] == [0, 1, 2, 3] # In order
+            assert all(item['result']['anonymous'] for item in output[:4])
+            assert output[4] == output[5] and output[4]['status'] == 401
+            assert output[6] == {'error':'bad input'}
+            assert 'oops' in output[7]['exception']
+            assert 'Could not find' in output[8]['error']
+            assert len(loads) == 1 # The user is only loaded once
+            assert (len(threads) > 1) == parallel
+
+        # A plain list of calls is run in order; too many calls are refused
+        assert client.post('/rpcs/batch', json=calls[:2]).get_json() == [{'result':{'x':0, 'anonymous':True}}, {'result':{'x':1, 'anonymous':True}}]
+        app.config['RPC_BATCH_MAX'] = 2
+        assert client.post('/rpcs/batch', json=calls).status_code == 413
 
 
 def test_run(app):
@@ -78,3 +332,86 @@ def test_run(app):
         response = client.get('/showgraph')
 
     assert response.status_code == 200
+
+
+def test_tempspace():
+    app = sw.ScirisApp(__name__, config=sw.Config(), TEMP_USER_QUOTA=1000)
+    tempspace = app.datastore.tempspace
+    contents = {}
+
+    @app.register_RPC(call_type='upload')
+    def upload(filename):
+        with open(filename) as f:
+            contents[filename] = f.read()
+        return 'ok'
+
+    @app.register_RPC(call_type='download')
+    def download():
+        filename = tempspace.path('output.txt')
+        with open(filename, 'w') as f:
+            f.write('data')
+        return filename
+
+    with app.flask_app.test_client() as client:
+
+        # Uploads go in the user's folder, and are removed afterwards
+        response = client.post('/rpcs', data={'funcname':'upload', 'uploadfile':(io.BytesIO(b'hello'), 'test.txt')})
+        assert response.status_code == 200
+        [(filename, content)] = contents.items()
+        assert content == 'hello' and os.path.dirname(filename) == tempspace.userfolder('_anonymous')
+        assert not os.path.exists(filename)
+
+        # Uploads over the quota are refused
+        response = client.post('/rpcs', data={'funcname':'upload', 'uploadfile':(io.BytesIO(b'x'*2000), 'big.txt')})
+        assert response.status_code == 413
+
+        # Downloaded temp files are removed once the response is closed
+        response = client.post('/rpcs', json={'funcname':'download'})
+        assert response.data == b'data'
+        response.close()
+        assert tempspace.usage() == 0
+
+    # Eviction: oldest files go first
+    paths = []
+    for i in range(3):
+        paths.append(tempspace.path('file%s' % i, username='user'))
+        with open(paths[-1], 'wb') as f:
+            f.write(b'x'*400)
+        os.utime(paths[-1], (i, i)) # Set the times so the order is clear
+    tempspace.sweep()
+    assert [os.path.exists(path) for path in paths] == [False, True, True]
+    tempspace.pin(paths[1])
+    tempspace.reserve(400, username='user')
+    assert [os.path.exists(path) for path in paths] == [False, True, False]
+    with pytest.raises(sw.QuotaExceededError):
+        tempspace.reserve(700, username='user') # Not enough room, since the remaining file is pinned
+    tempspace.release(paths[1])
+    assert tempspace.usage('user') == 0
+
+    # Usage is tracked between scans, so reserving room that's free doesn't walk the folder
+    scans = []
+    files = tempspace.files
+    tempspace.files = lambda: scans.append(1) or files()
+    tempspace.reserve(300, username='user')
+    tempspace.reserve(300, username='user')
+    assert len(scans) == 0
+    tempspace.reserve(500, username='user') # Over the running total, so check properly
+    assert len(scans) == 1
+    del tempspace.files
+
+    # Sweeping never raises, even if a user is over quota with files in use
+    tempspace.pin(paths[1])
+    with open(paths[1], 'wb') as f:
+        f.write(b'x'*1200)
+    assert tempspace._evict(user='user')['files'] == 0
+    tempspace.release(paths[1])
+
+    # Expiry
+    tempspace.maxage = 60
+    path = tempspace.path('old')
+    with open(path, 'w') as f:
+        f.write('old')
+    tempspace.sweep()
+    assert os.path.exists(path)
+    os.utime(path, (0, 0))
+    assert tempspace.sweep() == {'files':1, 'bytes':3}
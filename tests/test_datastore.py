@@ -4,6 +4,9 @@ test_datastore.py -- test module for sw_datastore.py
 
 import os
 import shutil
+import weakref
+import threading
+import flask
 import pytest
 import sciris as sc
 import scirisweb as sw
@@ -76,6 +79,12 @@ def test_datastore(url):
     assert ds.exists('foo')
     assert not ds.exists('nonexistent')
 
+    # TEST BATCH OPERATIONS
+    assert set(ds.iterkeys('f*')) == {'foo'}
+    blobs = ds.getmany(['foo', 'nonexistent', 'bar'])
+    assert blobs[0].load() == 'teststr' and blobs[1] is None and blobs[2].load() == 'teststr'
+    assert set(ds.items('?oo').keys()) == {'foo'}
+
     # Manually flush default redis ds if any test fails before reaching this point
     # redis.cli -h 127.0.0.1 -p 6379 FLUSHALL
     ds.flushdb()
@@ -139,9 +148,682 @@ def test_misc():
     ds.delete()
 
 
+def test_sharded():
+    shard_files = ['shard0.db', 'shard1.db', 'shard2.db']
+    shard_folder = './temp_test_shard'
+    shard_urls = [f'sqlite:///{shard_files[0]}', f'sqlite:///{shard_files[1]}', f'file://{shard_folder}/']
+    new_url = f'sqlite:///{shard_files[2]}'
+
+    ds = sw.make_datastore(shard_urls[:2])
+    assert isinstance(ds, sw.ShardedDataStore)
+    ds.flushdb()
+    ds = sw.make_datastore(shard_urls)
+    assert len(ds.keys()) == 1 # Only the datastore settings, even though each shard has its own
+
+    # Keys should be spread over the shards
+    keys = ['blob%s' % i for i in range(60)]
+    for key in keys:
+        ds.saveblob(obj=key, key=key)
+    assert set(ds.keys('blob*')) == set(keys)
+    assert set(ds.iterkeys('blob*')) == set(keys)
+    for shard in ds.shards.values():
+        assert 0 < len(shard.keys('blob*')) < len(keys)
+    assert [b.load() for b in ds.getmany(keys)] == keys
+    assert ds.loadblob('blob7') == 'blob7'
+
+    # Add a shard and rebalance incrementally: everything should be readable throughout
+    ring = ds.ring
+    ds.add_shard(new_url, rebalance=False)
+    assert ds.rebalancing()
+    assert ds.oldring is ring and new_url not in ring.nodes # The ring is replaced, not changed under lookups in other threads
+    moved = ds.rebalance(maxkeys=5, batch=2)
+    assert moved == 5
+    assert set(ds.keys('blob*')) == set(keys)
+    assert all(ds.loadblob(key) == key for key in keys)
+    ds.saveblob(obj='updated', key='blob3')
+
+    # A key that is moved between reading its new shard and its old one is still found
+    def moving(key):
+        oldshard, newshard = ds._oldshard(key), ds._shard(key)
+        def moved(k):
+            del oldshard._get # Just this once
+            newshard._set(k, oldshard._get(k)) # As rebalance() does
+            oldshard._delete(k)
+            return oldshard._get(k)
+        oldshard._get = moved
+    pending = [k for k in keys if ds._oldshard(k) is not None and ds._oldshard(k).exists(k)]
+    moving(pending[0])
+    assert ds.getmany(pending[:1])[0].load() == pending[0]
+    moving(pending[1])
+    assert ds.loadblob(pending[1]) == pending[1]
+    ds.rebalance()
+    assert not ds.rebalancing()
+    assert 0 < len(ds.shards[new_url].keys('blob*')) < len(keys)
+    assert sorted(ds.keys('blob*')) == sorted(keys)
+    assert ds.loadblob('blob3') == 'updated'
+    ds.delete('blob3')
+    assert not ds.exists('blob3')
+
+    # Tidy up
+    ds.flushdb()
+    for fn in shard_files:
+        try:    os.remove(fn)
+        except: pass
+    shutil.rmtree(shard_folder, ignore_errors=True)
+
+
+def test_replicas():
+    primary_file = 'primary.db'
+    replica_file = 'replica.db'
+    for fn in [primary_file, replica_file]:
+        if os.path.exists(fn): os.remove(fn)
+
+    # Create the primary, then copy it to make a "replica" that we can update by hand
+    ds = sw.make_datastore(f'sqlite:///{primary_file}')
+    ds.saveblob(obj='original', key='foo')
+    shutil.copy(primary_file, replica_file)
+    ds = sw.make_datastore(f'sqlite:///{primary_file}', replicas=[f'sqlite:///{replica_file}'], readwindow=0.2)
+    sc.timedsleep(0.3)
+
+    # Writes go to the primary, and are visible to this session straight away
+    ds.saveblob(obj='updated', key='foo')
+    assert ds.loadblob('foo') == 'updated'
+
+    # ...but after the read-your-writes window, reads go to the (stale) replica
+    sc.timedsleep(0.3)
+    assert ds.loadblob('foo') == 'original'
+    assert ds.stats()['reads_total'][f'target="sqlite:///{replica_file}"'] > 0
+
+    # The replica has not received a heartbeat, so its lag is unknown; once it's "replicated", it's up to date
+    assert ds.replica_lag()[0] is None
+    shutil.copy(primary_file, replica_file)
+    ds.maxlag = 10
+    assert ds.replica_lag()[0] < 10
+    assert ds.loadblob('foo') == 'updated'
+    assert sorted(ds.keys()) == ['!DataStoreSettings', 'foo'] # The heartbeat isn't a key
+
+    # In a request, the time of the last write is kept in the Flask session, so it follows the client to other workers
+    app = flask.Flask(__name__)
+    app.secret_key = 'test'
+    with app.test_request_context():
+        ds.saveblob(obj='updated', key='foo')
+        assert flask.session['_sw_lastwrite'] > 0
+        assert ds._lastwritten() == flask.session['_sw_lastwrite']
+    with app.test_request_context():
+        assert ds._lastwritten() is None # A different client
+
+    # With maxlag set, lagging replicas aren't used
+    ds.saveblob(obj='updated again', key='foo')
+    ds.maxlag = 1e-6
+    sc.timedsleep(0.3)
+    assert ds.replica_lag()[0] > ds.maxlag
+    assert ds.usable == []
+    assert ds.loadblob('foo') == 'updated again'
+
+    for fn in [primary_file, replica_file]:
+        if os.path.exists(fn): os.remove(fn)
+
+
+def test_writebehind():
+    base = sw.make_datastore(file_url)
+    ds = sw.make_datastore(file_url, writebehind=60) # Long interval so only explicit flushes happen
+    assert isinstance(ds, sw.WriteBehindDataStore)
+    ds.flush()
+
+    # Writes are coalesced and visible through the wrapper, but not in the backend until flushed
+    for i in range(5):
+        ds.saveblob(obj=i, key='counter')
+    ds.saveblob(obj='temp', key='temp')
+    assert ds.loadblob('counter') == 4
+    assert 'counter' in ds.keys() and ds.exists('temp')
+    assert not base.exists('counter')
+    assert ds.metrics.get('writebehind_coalesced_total') >= 4
+    ds.delete('temp')
+    assert not ds.exists('temp') and 'temp' not in ds.keys()
+    assert ds.flush() == 2
+    assert base.loadblob('counter') == 4
+    assert not base.exists('temp')
+
+    # Background and backpressure flushing
+    ds = sw.WriteBehindDataStore(base, interval=0.05)
+    ds.saveblob(obj='background', key='bg')
+    sc.timedsleep(0.3)
+    assert base.loadblob('bg') == 'background'
+    ds.close()
+    ds = sw.WriteBehindDataStore(base, interval=60, maxpending=2)
+    ds.flush()
+    ds.set('a', 1)
+    ds.set('b', 2)
+    assert base.get('a') == 1 and base.get('b') == 2
+    ds.close()
+    ref = weakref.ref(ds)
+    del ds
+    assert ref() is None # Nothing, e.g. atexit, keeps a closed wrapper alive
+
+    base.flushdb()
+    shutil.rmtree(db_folder, ignore_errors=True)
+
+
+def test_stats():
+    ds = sw.make_datastore(file_url)
+    ds.saveblob(obj='teststr', key='foo')
+    assert ds.loadblob('foo') == 'teststr'
+    ds.get('nonexistent')
+
+    # Check the recorded metrics
+    stats = ds.stats()
+    assert stats['ops_total']['op="set"'] >= 2 # Settings and blob
+    assert stats['ops_total']['op="get"'] >= 3
+    assert stats['misses_total']['op="get"'] >= 1
+    assert stats['bytes_total']['op="set"'] > 0
+    assert stats['codec_seconds']['op="get"']['count'] >= 1
+    assert sum(stats['exists_probes_total'].values()) > 0
+
+    # Check the Prometheus output
+    text = ds.stats(astype='prometheus')
+    assert '# TYPE scirisweb_datastore_backend_seconds histogram' in text
+    assert 'scirisweb_datastore_ops_total{backend="FileDataStore",op="set"}' in text
+    assert 'le="+Inf"' in text
+
+    # Check that instrumentation can be turned off
+    ds2 = sw.make_datastore(file_url, instrument=False)
+    ds2.loadblob('foo')
+    assert ds2.stats() == {}
+
+    ds.flushdb()
+    shutil.rmtree(db_folder, ignore_errors=True)
+
+
+def test_raw_codec():
+    np = pytest.importorskip('numpy')
+    data = {'arr':np.arange(100_000, dtype=float), 'label':'test'}
+
+    # On a file datastore, arrays should be mapped rather than read
+    ds = sw.make_datastore(file_url, codec='raw')
+    ds.saveblob(obj=data, key='arrays')
+    out = ds.loadblob('arrays')
+    assert np.array_equal(out['arr'], data['arr']) and out['label'] == 'test'
+    base = out['arr']
+    while getattr(base, 'base', None) is not None and not isinstance(base, memoryview):
+        base = base.base
+    assert isinstance(base, memoryview) # Backed by the mapping, not a copy
+    out['arr'][0] = -1 # Copy-on-write: the stored data shouldn't change
+    assert ds.loadblob('arrays')['arr'][0] == 0
+
+    # Overwriting a mapped file should leave existing arrays intact
+    ds.saveblob(obj={'arr':np.zeros(10)}, key='arrays')
+    assert out['arr'][1] == 1
+    assert not any(key.startswith('.') for key in ds.keys())
+
+    # Both codecs should be readable from either store, including the SQL one
+    ds.set('pickled', data, codec='pickle')
+    assert np.array_equal(sw.make_datastore(file_url).get('pickled')['arr'], data['arr'])
+    ds.flushdb()
+    sqlds = sw.make_datastore(sql_url, codec='raw')
+    sqlds.set('raw', data)
+    out = sqlds.get('raw')
+    assert np.array_equal(out['arr'], data['arr']) and out['arr'].flags.writeable
+    sqlds.flushdb()
+    shutil.rmtree(db_folder, ignore_errors=True)
+
+
+@pytest.mark.parametrize('url', urls)
+def test_changefeed(url):
+    import threading
+    ds = sw.make_datastore(url)
+    ds.flushdb()
+    ds = sw.make_datastore(url, changefeed=True)
+    start = ds.lastversion()
+    ds.set('foo', 1)
+    ds.set('bar', 2)
+    ds.delete('foo')
+    changes = ds.changes(since=start)
+    assert [(c['key'], c['op']) for c in changes] == [('foo', 'set'), ('bar', 'set'), ('foo', 'delete')]
+    assert ds.changes(since=changes[-1]['version']) == []
+    assert 'foo' not in ds.keys() and len(ds.keys()) == 2 # The feed itself isn't a key
+
+    # Watching blocks until there's a change from another datastore instance
+    seen = []
+    since = ds.lastversion() # So that changes made before the thread starts watching aren't missed
+    def watcher():
+        for change in ds.watch('proj*', since=since, timeout=5):
+            seen.append(change['key'])
+            if len(seen) == 2: break
+    thread = threading.Thread(target=watcher)
+    thread.start()
+    other = sw.make_datastore(url, changefeed=True)
+    other.set('other', 3)
+    other.set('proj1', 4)
+    other.delete('proj1')
+    thread.join(timeout=10)
+    assert seen == ['proj1', 'proj1']
+
+    # With write-behind, changes are published when flushed
+    wb = sw.WriteBehindDataStore(other, interval=60)
+    wb.flush() # The settings
+    last = wb.lastversion()
+    wb.set('proj2', 5)
+    assert wb.changes(since=last) == []
+    wb.flush()
+    assert [c['key'] for c in wb.changes(since=last)] == ['proj2']
+    wb.close()
+
+    with pytest.raises(ValueError):
+        sw.make_datastore(url).changes()
+    ds.flushdb()
+    shutil.rmtree(db_folder, ignore_errors=True)
+
+
+@pytest.mark.parametrize('url', urls)
+def test_accounting(url):
+    ds = sw.make_datastore(url)
+    ds.flushdb()
+    ds = sw.make_datastore(url, accounting=True, quota={'alice':5000})
+    ds.set(objtype='project', uid='a', obj='x'*100, owner='alice')
+    ds.set(objtype='project', uid='b', obj='y'*100, owner='bob')
+    ds.set(objtype='result', uid='c', obj='z', owner='alice')
+    alice = ds.usage('owner', 'alice')
+    assert alice['keys'] == 2 and alice['bytes'] > 0
+    assert ds.usage('objtype')['project']['keys'] == 2
+
+    # Overwriting keeps the owner and adjusts the size; deleting removes it
+    ds.set('project::a', 'x'*1000)
+    assert ds.usage('owner', 'alice')['keys'] == 2
+    assert ds.usage('owner', 'alice')['bytes'] > alice['bytes']
+    ds.delete('result::c')
+    assert ds.usage('owner', 'alice')['keys'] == 1
+    assert 'result' not in ds.usage('objtype')
+
+    # Quotas
+    with pytest.raises(sw.QuotaExceededError):
+        ds.set('project::big', sc.dumpstr(list(range(10000))), owner='alice')
+    ds.set('project::big', 'fine', owner='bob')
+
+    # The check and the counters are updated together: concurrent saves can't go over quota, and failed saves are uncounted
+    def save(i):
+        try:    ds.set('project::thread%s' % i, 'w'*1000, owner='alice')
+        except sw.QuotaExceededError: pass
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert ds.usage('owner', 'alice')['bytes'] <= 5000
+    before = ds.usage('owner', 'bob')
+    _set = ds._set
+    def broken(key, objstr): raise IOError('disk full')
+    ds._set = broken
+    with pytest.raises(IOError):
+        ds.set('project::lost', 'v'*100, owner='bob')
+    ds._set = _set
+    assert ds.usage('owner', 'bob') == before
+    for i in range(8): ds.delete('project::thread%s' % i)
+
+    # Array chunks count towards the quota too; a save that doesn't fit leaves the old array as it was
+    import numpy as np
+    key = ds.savearray(np.arange(10), objtype='results', owner='alice')
+    before = ds.usage('owner', 'alice')
+    with pytest.raises(sw.QuotaExceededError):
+        ds.savearray(np.random.rand(100000), key=key, chunks=(1000,))
+    assert ds.usage('owner', 'alice') == before
+    assert len(ds.keys(key + '#*')) == 1
+    assert np.array_equal(ds.loadarray(key), np.arange(10))
+    ds.deletearray(key)
+
+    # Recounting fixes drift, e.g. from writes without accounting
+    plain = sw.make_datastore(url)
+    plain.set('project::d', 'untracked')
+    plain.delete('project::b')
+    drift = ds.recount()
+    assert drift['objtype']['project']['keys'] == 0 # One added, one removed
+    assert drift['owner']['']['keys'] == 1
+    assert ds.usage('owner', 'bob')['keys'] == 1 # Owners are kept
+    assert ds.recount() == {}
+
+    ds.flushdb()
+    assert ds.usage('owner') == {}
+    shutil.rmtree(db_folder, ignore_errors=True)
+    if os.path.exists(db_folder + '.accounting.db'): os.remove(db_folder + '.accounting.db')
+
+
+def test_resilience():
+    import sqlalchemy
+    ds = sw.make_datastore(sql_url, retries=2, backoff=0.001, breaker={'threshold':2, 'reset':0.2})
+    ds.set('foo', 'bar')
+    get_session = ds.get_session
+    calls = []
+    def broken():
+        calls.append(1)
+        raise sqlalchemy.exc.OperationalError('SELECT', {}, Exception('could not connect to server'))
+
+    # Reads are retried, writes aren't, and both count towards opening the breaker
+    ds.get_session = broken
+    with pytest.raises(sw.DataStoreUnavailable):
+        ds.get('foo')
+    assert len(calls) == 3
+    with pytest.raises(sw.DataStoreUnavailable):
+        ds._set('foo', sc.dumpstr('baz'))
+    assert len(calls) == 4
+    stats = ds.stats()
+    assert stats['retries_total']['op="get"'] == 2
+    assert stats['circuit_state'][''] == 1 and stats['circuit_trips_total'][''] == 1
+
+    # While open, calls fail without reaching the backend
+    with pytest.raises(sw.DataStoreUnavailable):
+        ds.get('foo')
+    assert len(calls) == 4
+
+    # After the reset time, a successful trial call closes it again
+    ds.get_session = get_session
+    sc.timedsleep(0.25)
+    assert ds.get('foo') == 'bar'
+    assert ds.stats()['circuit_state'][''] == 0
+    ds.flushdb()
+
+
+def test_compact():
+    from scirisweb import sw_cli
+
+    # SQLite: space from deleted items is released incrementally
+    compact_file = 'compact.db'
+    if os.path.exists(compact_file): os.remove(compact_file)
+    ds = sw.make_datastore(f'sqlite:///{compact_file}')
+    ds.set('foo', 'bar')
+    for i in range(50):
+        ds.set('big::%s' % i, os.urandom(50_000))
+    for i in range(50):
+        ds.delete('big::%s' % i)
+    size = os.path.getsize(compact_file)
+    report = ds.compact()
+    assert report['reclaimed'] > 2e6
+    assert os.path.getsize(compact_file) < size - 2e6
+    assert ds.get('foo') == 'bar'
+    ds.engine.dispose()
+    os.remove(compact_file)
+
+    # Files: abandoned partial writes are removed, recent ones are left alone
+    ds = sw.make_datastore(file_url)
+    ds.set('foo', 'bar')
+    old = os.path.join(ds.path, '.swtmp.old')
+    new = os.path.join(ds.path, '.swtmp.new')
+    for path in [old, new]:
+        with open(path, 'wb') as f: f.write(b'x'*1000)
+    os.utime(old, (0, 0))
+    report = sw_cli.main(['compact', file_url])
+    assert report['partial'] == {'files':1, 'bytes':1000}
+    assert report['reclaimed'] == 1000
+    assert not os.path.exists(old) and os.path.exists(new)
+    assert ds.get('foo') == 'bar'
+    shutil.rmtree(db_folder, ignore_errors=True)
+
+
+def test_identitymap():
+    import flask
+    flaskapp = flask.Flask(__name__)
+    ds = sw.make_datastore(sql_url, identitymap=True)
+    ds.saveuser(sw.User(username='mapped'))
+    ds.saveblob(obj=[1,2,3], key='blob::mapped')
+
+    # Within a request, repeated loads return the same object without reading again
+    with flaskapp.test_request_context():
+        user = ds.loaduser('mapped')
+        gets = ds.stats()['ops_total'].get('op="get"', 0)
+        assert ds.loaduser('mapped') is user
+        assert ds.loadblob('blob::mapped') is ds.loadblob('blob::mapped')
+        assert ds.stats()['ops_total']['op="get"'] == gets + 1 # Only the first blob load
+        assert ds.stats()['identitymap_hits_total']['op="get"'] >= 2
+
+        # Writes drop the key, so the next read sees the new version
+        user.displayname = 'Changed'
+        ds.saveuser(user)
+        reloaded = ds.loaduser('mapped')
+        assert reloaded is not user and reloaded.displayname == 'Changed'
+        ds.delete('blob::mapped')
+        assert ds.get('blob::mapped') is None
+
+    # Each request starts afresh, and there is no map outside a request
+    with flaskapp.test_request_context():
+        assert ds.loaduser('mapped') is not reloaded
+    assert ds.loaduser('mapped') is not ds.loaduser('mapped')
+    ds.delete('user::mapped')
+
+
+@pytest.mark.parametrize('url', urls)
+def test_delete_pattern(url):
+    ds = sw.make_datastore(url)
+    ds.flushdb()
+    ds = sw.make_datastore(url)
+    for i in range(25):
+        ds.set('task::%s' % i, i)
+    ds.set('task_100', 'similar') # Not matched: "_" and "%" are literal
+    ds.set('project::1', 'kept')
+    assert ds.delete_pattern('task::*', batch=10) == 25
+    assert sorted(ds.keys('*')) == sorted(['!DataStoreSettings', 'task_100', 'project::1'])
+    assert ds.delete_pattern('task::*') == 0
+    assert ds.delete_pattern('task_1?0') == 1
+
+    # With accounting and the change feed, each key removed is still counted and published
+    ds = sw.make_datastore(url, accounting=True, changefeed=True)
+    ds.recount()
+    for i in range(5):
+        ds.set('blob::%s' % i, i, owner='alice')
+    since = ds.lastversion()
+    assert ds.delete_pattern('blob::*', batch=2) == 5
+    assert 'alice' not in ds.usage('owner')
+    assert sorted([c['key'] for c in ds.changes(since) if c['op'] == 'delete']) == ['blob::%s' % i for i in range(5)]
+    assert ds.get('project::1') == 'kept'
+
+    ds.flushdb()
+    shutil.rmtree(db_folder, ignore_errors=True)
+    for suffix in ['.accounting.db', '.changes']:
+        if os.path.exists(db_folder + suffix): os.remove(db_folder + suffix)
+
+
+@pytest.mark.parametrize('url', urls)
+def test_arrays(url):
+    import numpy as np
+    ds = sw.make_datastore(url)
+    ds.flushdb()
+    ds = sw.make_datastore(url)
+    arr = np.random.rand(20, 30, 7)
+    key = ds.savearray(arr, objtype='results', chunks=(1, 16, 7))
+    assert isinstance(ds.get(key), sw.ArrayBlob)
+    assert len(ds.keys(key + '#*')) == 40
+    for slices in [None, 5, -1, np.s_[2:9, ::-3], np.s_[..., 2], np.s_[19, 29, 6], np.s_[5:2], np.s_[::-1, 3:17:5, 1:]]:
+        expected = arr if slices is None else arr[slices]
+        loaded = ds.loadarray(key, slices)
+        assert loaded.shape == expected.shape and np.array_equal(loaded, expected)
+
+    # Only the chunks that are needed are read
+    before = ds.stats()['bytes_total']['op="loadarray"']
+    ds.loadarray(key, np.s_[3, :10])
+    assert ds.stats()['bytes_total']['op="loadarray"'] - before < arr[0].nbytes # Only one of the 40 chunks
+
+    # Overwriting with a different shape removes the old chunks; deleting removes them all
+    ds.savearray(np.arange(6), key=key)
+    assert len(ds.keys(key + '#*')) == 1 and ds.keys(key + '#*')[0].endswith('#0')
+    assert np.array_equal(ds.loadarray(key, np.s_[1::2]), [1, 3, 5])
+    ds.deletearray(key)
+    assert ds.keys('results*') == []
+
+    # Arrays saved in a regular Blob can be loaded too
+    ds.saveblob(obj=arr, key='blob::arr')
+    assert np.array_equal(ds.loadarray('blob::arr', np.s_[1, 2]), arr[1, 2])
+    with pytest.raises(TypeError):
+        ds.savearray(np.array([None, 'x']), key='results::objects')
+    ds.flushdb()
+    shutil.rmtree(db_folder, ignore_errors=True)
+
+
+@pytest.mark.parametrize('url', urls)
+def test_dataframes(url):
+    import numpy as np
+    import pandas as pd
+    ds = sw.make_datastore(url)
+    ds.flushdb()
+    ds = sw.make_datastore(url)
+    n = 1000
+    df = sc.dataframe(dict(
+        year  = np.arange(n),
+        cases = np.random.rand(n),
+        name  = ['s%s' % i for i in range(n)],
+        group = pd.Categorical(['x', 'y']*(n//2)),
+    ))
+    key = ds.savedataframe(df, objtype='results', rowchunk=100)
+    assert isinstance(ds.get(key), sw.DataFrameBlob)
+    loaded = ds.loaddataframe(key)
+    assert isinstance(loaded, sc.dataframe)
+    pd.testing.assert_frame_equal(pd.DataFrame(loaded), pd.DataFrame(df))
+
+    # Only the requested columns and rows are read
+    before = ds.stats()['bytes_total']['op="loaddataframe"']
+    part = ds.loaddataframe(key, columns=['name', 'year'], rows=slice(250, 260))
+    pd.testing.assert_frame_equal(pd.DataFrame(part), pd.DataFrame(df[['name', 'year']].iloc[250:260]))
+    assert ds.stats()['bytes_total']['op="loaddataframe"'] - before < 2000 # One chunk of each of two columns
+    assert ds.loaddataframe(key, rows=-1)['year'].tolist() == [n-1]
+    with pytest.raises(KeyError):
+        ds.loaddataframe(key, columns=['missing'])
+
+    # Other indexes are stored too; replacing or deleting removes the old columns
+    df2 = pd.DataFrame({'x':[1.0, 2.0, 3.0]}, index=pd.Index(['r1', 'r2', 'r3'], name='row'))
+    ds.savedataframe(df2, key=key)
+    pd.testing.assert_frame_equal(ds.loaddataframe(key, rows=slice(1, None)), df2.iloc[1:])
+    generation = ds.get(key).generation
+    assert sorted(ds.keys(key + '#*')) == [key + '#%s#0#0' % generation, key + '#%s#index#0' % generation]
+    ds.deletedataframe(key)
+    assert ds.keys('results*') == []
+    ds.flushdb()
+    shutil.rmtree(db_folder, ignore_errors=True)
+
+
+@pytest.mark.parametrize('changefeed', [False, True])
+def test_backup(changefeed):
+    from scirisweb import sw_cli
+    backup_folder = './temp_test_backups'
+    shutil.rmtree(backup_folder, ignore_errors=True)
+    ds = sw.make_datastore(sql_url)
+    ds.flushdb()
+    ds = sw.make_datastore(sql_url, changefeed=changefeed)
+    for i in range(5):
+        ds.set('item::%s' % i, i)
+    for i in range(6):
+        ds.set('_aux%s' % i, i) # Skipped, even when they fill whole batches
+
+    # The first backup is full; the next ones only have the changes and deletions
+    base = sw.backup_datastore(ds, backup_folder, batch=3)
+    assert base['kind'] == 'full' and len(base['items']) == 6 # Including the settings
+    ds.set('item::0', 'changed')
+    ds.set('item::5', 5)
+    ds.delete('item::1')
+    incr = sw.backup_datastore(ds, backup_folder)
+    assert incr['method'] == ('changes' if changefeed else 'hashes')
+    assert sorted(incr['items']) == ['item::0', 'item::5']
+    assert incr['deleted'] == ['item::1']
+    ds.delete('item::2')
+    last = sw_cli.main(['backup', sql_url, '--to', backup_folder] + (['--changefeed'] if changefeed else []))
+    assert last['deleted'] == 1 and last['method'] == incr['method']
+    assert [b['kind'] for b in sw_cli.main(['backups', backup_folder])] == ['full', 'incremental', 'incremental']
+
+    # Restore to each point
+    restored = sw.restore_datastore(backup_folder, file_url, until=base['id'])
+    assert sorted(restored.keys('item*')) == ['item::%s' % i for i in range(5)]
+    assert restored.get('item::0') == 0
+    restored = sw.restore_datastore(backup_folder, file_url, until=incr['id'])
+    assert sorted(restored.keys('item*')) == ['item::0', 'item::2', 'item::3', 'item::4', 'item::5']
+    assert restored.get('item::0') == 'changed'
+    sw_cli.main(['restore', backup_folder, file_url])
+    assert sorted(restored.keys('item*')) == ['item::0', 'item::3', 'item::4', 'item::5']
+
+    ds.flushdb()
+    shutil.rmtree(backup_folder, ignore_errors=True)
+    shutil.rmtree(db_folder, ignore_errors=True)
+
+def test_analyze():
+    import json
+    import datetime
+    import numpy as np
+    from scirisweb import sw_cli
+    report_file = 'temp_test_analyze.json'
+    ds = sw.make_datastore(sql_url)
+    ds.flushdb()
+    ds = sw.make_datastore(sql_url)
+    for i in range(20):
+        ds.saveblob(obj=np.zeros(100*i), key='blob::%s' % i)
+    old = ds.get('blob::0')
+    old.modified = [sc.now() - datetime.timedelta(days=400+i) for i in range(3)][::-1]
+    ds.set('blob::0', old)
+    ds.savearray(np.random.rand(50, 50), key='arr::0', chunks=(10, 50))
+
+    # Every size is counted, but only the sample is decoded
+    report = ds.analyze(sample=10, top=3, seed=1)
+    assert report['overall']['keys'] == len(ds.keys())
+    assert report['overall']['bytes'] == sum([x['bytes'] for x in report['objtypes'].values()])
+    assert report['overall']['sampled'] == 10
+    blobs = report['objtypes']['blob']
+    assert blobs['keys'] == 20 and sum(blobs['histogram'].values()) == 20
+    assert [x['bytes'] for x in blobs['largest']] == sorted(ds._sizes(ds.keys('blob*')))[::-1][:3]
+    assert report['objtypes']['arr']['keys'] == 6 # Manifest plus five chunks
+
+    # With everything sampled, the stale blob and its history are found
+    report = sw_cli.main(['analyze', sql_url, '--pattern', 'blob*', '--top', '1', '--output', report_file])
+    assert report['overall']['sampled'] == 20 and report['overall']['stale'] == 1
+    assert report['stalest'] == [dict(key='blob::0', objtype='blob', bytes=report['stalest'][0]['bytes'], modified=old.modified[-1].isoformat(), history=3)]
+    assert report['objtypes']['blob']['ratio'] > 1 # Zeros compress well
+    with open(report_file) as f:
+        assert json.load(f)['overall']['keys'] == 20
+    os.remove(report_file)
+    ds.flushdb()
+
+def test_records():
+    from scirisweb.sw_datastore import record_magic
+    ds = sw.make_datastore(sql_url)
+    ds.flushdb()
+
+    # Users and tasks are stored as records, and read back with the same attributes
+    ds = sw.make_datastore(sql_url)
+    user = sw.User(username='alice', raw_password='secret', email='alice@example.com')
+    key = ds.saveuser(user)
+    assert ds._get(key)[:len(record_magic)] == record_magic
+    loaded = ds.loaduser('alice')
+    assert [getattr(loaded, attr) for attr in user.__slots__] == [getattr(user, attr) for attr in user.__slots__]
+    task = sw.Task('task1')
+    task.args, task.kwargs, task.queue_time = [1, 'a'], {'b':[2.5]}, sc.now()
+    ds.savetask(task)
+    assert ds.loadtask('task1').jsonify() == task.jsonify()
+
+    # Anything the schema can't hold is pickled instead
+    task.args = (1, 2)
+    ds.savetask(task)
+    assert ds._get('task::task1')[:len(record_magic)] != record_magic
+    assert ds.loadtask('task1').args == (1, 2)
+
+    # Pickles from before records, or with records turned off, can still be read
+    old = sw.make_datastore(sql_url, records=False)
+    old.saveuser(sw.User(username='bob'))
+    assert ds._get('user::bob')[:len(record_magic)] != record_magic
+    assert ds.loaduser('bob').username == 'bob'
+    ds.flushdb()
+
+
 if __name__ == '__main__':
     for url in urls:
         test_datastore(url)
     test_misc()
     test_copy_datastore()
-
+    test_sharded()
+    test_replicas()
+    test_writebehind()
+    test_stats()
+    test_raw_codec()
+    for url in urls:
+        test_changefeed(url)
+        test_accounting(url)
+    test_resilience()
+    test_compact()
+    test_identitymap()
+    for changefeed in [False, True]:
+        test_backup(changefeed)
+    for url in urls:
+        test_delete_pattern(url)
+        test_arrays(url)
+        test_dataframes(url)
+    test_analyze()
+    test_records()
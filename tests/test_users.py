@@ -113,6 +113,16 @@ def test_make_default_users(app):
         assert admin_user.is_admin
 
 
+def test_datastore_stats(app):
+    """ Test the admin datastore metrics RPC """
+    assert 'admin_datastore_stats' in app.RPC_dict
+    with app.flask_app.app_context():
+        text = sw.admin_datastore_stats()
+        assert 'scirisweb_datastore_ops_total' in text
+        stats = sw.admin_datastore_stats(astype='dict')
+        assert 'backend_seconds' in stats
+
+
 def test_jsonify():
     """ Test JSON representation"""
     user = sw.User()